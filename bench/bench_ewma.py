@@ -0,0 +1,87 @@
+#!/usr/bin/python2
+# vim:set ts=4 sw=4 et nowrap syntax=python ff=unix:
+#
+# Copyright 2011-2018 Mark Crewson <mark@crewson.net>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+#
+# Benchmark for the EWMA decay tick. Reports how long one decay tick takes
+# for the EWMA engine (with numpy when it is installed, and with the plain
+# array fallback) and for the old one-object-per-EWMA loop. Each meter
+# has three EWMAs, so N EWMAs are N/3 meters.
+#
+#   python2 bench/bench_ewma.py [ticks]
+#
+
+import os, random, sys, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from squib import statistics
+
+##############################################################################
+
+SIZES = (10000, 100000, 1000000)
+
+def time_ticks (decay, mark, ticks):
+    best = None
+    for t in xrange(ticks):
+        mark()
+        start = time.time()
+        decay()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def bench_engine (ewmas, ticks):
+    engine = statistics.EWMAEngine()
+    handles = [ statistics.MeterRates(engine) for i in xrange(ewmas // 3) ]
+    marked = random.sample(handles, min(len(handles), 1000))
+    def mark ():
+        for h in marked:
+            h.update(5)
+    return time_ticks(engine.decay, mark, ticks)
+
+def bench_objects (ewmas, ticks):
+    objects = [ statistics.ExponentiallyWeightedMovingAverage(statistics.M1_ALPHA, statistics.EWMA_DECAY_INTERVAL)
+                for i in xrange(ewmas) ]
+    for ewma in objects:
+        ewma.close()
+    marked = random.sample(objects, min(len(objects), 1000))
+    def mark ():
+        for ewma in marked:
+            ewma.update(5)
+    def decay ():
+        for ewma in objects:
+            ewma.decay()
+    return time_ticks(decay, mark, ticks)
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        ticks = int(sys.argv[1])
+    else:
+        ticks = 5
+
+    numpy = statistics.numpy
+    for ewmas in SIZES:
+        if numpy is not None:
+            print "%8d EWMAs, engine (numpy):  %9.3f ms/tick" % (ewmas, bench_engine(ewmas, ticks) * 1000)
+        statistics.numpy = None
+        print "%8d EWMAs, engine (array):  %9.3f ms/tick" % (ewmas, bench_engine(ewmas, ticks) * 1000)
+        statistics.numpy = numpy
+        print "%8d EWMAs, one per object:  %9.3f ms/tick" % (ewmas, bench_objects(ewmas, ticks) * 1000)
+
+##############################################################################
+## THE END
@@ -0,0 +1,86 @@
+#!/usr/bin/python2
+# vim:set ts=4 sw=4 et nowrap syntax=python ff=unix:
+#
+# Copyright 2011-2018 Mark Crewson <mark@crewson.net>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+#
+# Memory benchmark for the metric objects. Records a number of distinct
+# series of each metric type, each in a fresh process, and reports the
+# resident memory growth per series. The series names and the recorder's
+# dictionaries are included, as they would be in a running squib.
+#
+#   python2 bench/bench_memory.py [series]
+#
+
+import gc, os, resource, sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from squib import metrics
+
+##############################################################################
+
+METRIC_TYPES = ('gauge', 'counter', 'string', 'derivgauge', 'meter', 'derivmeter', 'hist')
+
+def rss ():
+    try:
+        fp = open('/proc/self/statm')
+        pages = int(fp.read().split()[1])
+        fp.close()
+        return pages * resource.getpagesize()
+    except (IOError, OSError, ValueError):
+        # ru_maxrss is in kilobytes on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def measure (mtype, series):
+    recorder = metrics.MetricsRecorder(prefix='bench.')
+    names = [ 'bench.%s.series%d' % (mtype, i) for i in xrange(series) ]
+    value = '%s 1' % mtype
+    gc.collect()
+    before = rss()
+    for name in names:
+        recorder.record(name, value)
+    gc.collect()
+    after = rss()
+    return (after - before) / float(series)
+
+def run_child (mtype, series):
+    rfd, wfd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(rfd)
+        os.write(wfd, '%f' % measure(mtype, series))
+        os._exit(0)
+    os.close(wfd)
+    result = os.read(rfd, 64)
+    os.close(rfd)
+    os.waitpid(pid, 0)
+    return float(result)
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        series = int(sys.argv[1])
+    else:
+        series = 100000
+    for mtype in METRIC_TYPES:
+        if mtype == 'hist':
+            # Each histogram holds a 1028 value reservoir; fewer will do
+            count = max(1, series // 20)
+        else:
+            count = series
+        print "%-10s %7d series: %8.0f bytes/series" % (mtype, count, run_child(mtype, count))
+
+##############################################################################
+## THE END
@@ -0,0 +1,85 @@
+#!/usr/bin/python2
+# vim:set ts=4 sw=4 et nowrap syntax=python ff=unix:
+#
+# Copyright 2011-2018 Mark Crewson <mark@crewson.net>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+#
+# Benchmark for building a Graphite report. Times the plaintext message
+# GraphiteReporter used to build (publish, then split every line to drop
+# the strings), the numeric only publish_text() it builds now, and the
+# pickle frames of GraphitePickleReporter.
+#
+#   python2 bench/bench_pickle.py [series ...]
+#
+
+import os, random, sys, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from squib import metrics, reporter
+
+##############################################################################
+
+SIZES = (10000, 50000, 100000)
+
+# (metric type, share of the series)
+MIX = (('gauge', 0.6), ('counter', 0.2), ('meter', 0.15), ('hist', 0.05))
+
+BATCH_SIZE = reporter.GraphitePickleReporter.default_batch_size
+
+def build (series):
+    recorder = metrics.MetricsRecorder(prefix='benchhost.')
+    lines = []
+    for mtype, share in MIX:
+        for i in xrange(int(series * share)):
+            lines.append('bench.%s.series%d %s %d' % (mtype, i, mtype, random.randint(1, 1000)))
+    recorder.record_many(lines)
+    recorder.publish()
+    return recorder, lines
+
+def old_text (recorder):
+    lines = [l for l in recorder.publish() if not l.split()[1].startswith('"')]
+    return '\n'.join(lines) + '\n'
+
+def new_text (recorder):
+    return recorder.publish_text(numeric_only=True)
+
+def pickled (recorder):
+    return reporter.pickle_datapoints(recorder.publish_datapoints(), BATCH_SIZE)
+
+def bench (series):
+    recorder, lines = build(series)
+    results = []
+    for build_report in (old_text, new_text, pickled):
+        # Timed in the steady state: every report built once before, and a
+        # tenth of the series updated since
+        build_report(recorder)
+        recorder.record_many(random.sample(lines, len(lines) // 10))
+        start = time.time()
+        message = build_report(recorder)
+        results.append((time.time() - start, len(message)))
+    print "%7d series: " % series + ", ".join([ "%s %7.1f ms %6d KB" % (name, elapsed * 1000, size // 1024)
+                                               for name, (elapsed, size) in zip(('old text', 'text', 'pickle'), results) ])
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        sizes = [ int(arg) for arg in sys.argv[1:] ]
+    else:
+        sizes = SIZES
+    for series in sizes:
+        bench(series)
+
+##############################################################################
+## THE END
@@ -0,0 +1,77 @@
+#!/usr/bin/python2
+# vim:set ts=4 sw=4 et nowrap syntax=python ff=unix:
+#
+# Copyright 2011-2018 Mark Crewson <mark@crewson.net>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+#
+# Benchmark for MetricsRecorder.publish(). Builds a recorder with a mix of
+# gauges, counters, meters and histograms, then times a publish after 10%
+# of the series were updated, as in a typical report period. publish()
+# returns a list of lines, publish_text() the report as one string.
+#
+#   python2 bench/bench_publish.py [series ...]
+#
+
+import os, random, sys, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from squib import metrics
+
+##############################################################################
+
+SIZES = (10000, 100000, 500000)
+
+# (metric type, share of the series)
+MIX = (('gauge', 0.6), ('counter', 0.2), ('meter', 0.15), ('hist', 0.05))
+
+def build (series):
+    recorder = metrics.MetricsRecorder(prefix='benchhost.')
+    lines = []
+    for mtype, share in MIX:
+        for i in xrange(int(series * share)):
+            lines.append('bench.%s.series%d %s %d' % (mtype, i, mtype, random.randint(1, 1000)))
+    random.shuffle(lines)
+    recorder.record_many(lines)
+    return recorder, lines
+
+def bench (series):
+    recorder, lines = build(series)
+    start = time.time()
+    recorder.publish()
+    first = time.time() - start
+
+    recorder.record_many(random.sample(lines, len(lines) // 10))
+    start = time.time()
+    report = recorder.publish()
+    elapsed = time.time() - start
+
+    recorder.record_many(random.sample(lines, len(lines) // 10))
+    start = time.time()
+    recorder.publish_text()
+    elapsed_text = time.time() - start
+    print "%7d series, %8d lines: first publish %8.1f ms, next publish %8.1f ms, next publish_text %8.1f ms" % (
+        series, len(report), first * 1000, elapsed * 1000, elapsed_text * 1000)
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        sizes = [ int(arg) for arg in sys.argv[1:] ]
+    else:
+        sizes = SIZES
+    for series in sizes:
+        bench(series)
+
+##############################################################################
+## THE END
@@ -0,0 +1,95 @@
+#!/usr/bin/python2
+# vim:set ts=4 sw=4 et nowrap syntax=python ff=unix:
+#
+# Copyright 2011-2018 Mark Crewson <mark@crewson.net>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+#
+# Micro-benchmark for MetricsRecorder.record(). Feeds a mix of lines shaped
+# like the ones the bundled oxidizers emit and reports lines/sec.
+#
+#   python2 bench/bench_record.py [rounds]
+#
+
+import os, sys, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from squib import metrics
+
+##############################################################################
+
+def oxidizer_lines ():
+    lines = []
+    for x in ('user', 'nice', 'system', 'idle', 'iowait', 'irq', 'softirq'):
+        lines.append(('cpu.%s' % x, '12.34'))
+    for x in ('total', 'free', 'buffers', 'cached', 'used'):
+        lines.append(('mem.%s' % x, '1073741824'))
+    for iface in ('eth0', 'eth1', 'eth2', 'eth3'):
+        for x in ('rtraffic', 'ttraffic'):
+            lines.append(('traffic.%s.%s' % (iface, x), 'derivgauge 123456789'))
+            lines.append(('traffic.%s.%s' % (iface, x), 'derivmeter 123456789'))
+    for backend in range(20):
+        for x in ('qcur', 'scur', 'slim', 'stot', 'bin', 'bout'):
+            lines.append(('haproxy.be%d.srv.%s' % (backend, x), 'gauge 42'))
+        lines.append(('haproxy.be%d.srv.status' % backend, 'string UP'))
+    for db in range(5):
+        lines.append(('pgbouncer.db%d.app.maxwait_us' % db, 'hist 1500'))
+        lines.append(('pgbouncer.db%d.xact_count' % db, 'derivmeter 100000'))
+    return lines
+
+def bench (rounds):
+    recorder = metrics.MetricsRecorder(prefix='bench.')
+    lines = oxidizer_lines()
+    record = recorder.record
+    start = time.time()
+    for r in xrange(rounds):
+        for name, value in lines:
+            record(name, value)
+    elapsed = time.time() - start
+    total = rounds * len(lines)
+    print "record():      %d lines in %.3f seconds: %d lines/sec" % (total, elapsed, total / elapsed)
+
+def bench_many (rounds):
+    recorder = metrics.MetricsRecorder(prefix='bench.')
+    chunk = [ '%s %s' % (name, value) for name, value in oxidizer_lines() ]
+    record_many = recorder.record_many
+    start = time.time()
+    for r in xrange(rounds):
+        record_many(chunk)
+    elapsed = time.time() - start
+    total = rounds * len(chunk)
+    print "record_many(): %d lines in %.3f seconds: %d lines/sec" % (total, elapsed, total / elapsed)
+
+    # The same chunks, fed one line at a time
+    recorder = metrics.MetricsRecorder(prefix='bench.')
+    record = recorder.record
+    start = time.time()
+    for r in xrange(rounds):
+        for line in chunk:
+            mname, mvalue = line.split(' ', 1)
+            record(mname, mvalue)
+    elapsed = time.time() - start
+    print "split+record:  %d lines in %.3f seconds: %d lines/sec" % (total, elapsed, total / elapsed)
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        rounds = int(sys.argv[1])
+    else:
+        rounds = 2000
+    bench(rounds)
+    bench_many(rounds)
+
+##############################################################################
+## THE END
@@ -0,0 +1,90 @@
+#!/usr/bin/python2
+# vim:set ts=4 sw=4 et nowrap syntax=python ff=unix:
+#
+# Copyright 2011-2018 Mark Crewson <mark@crewson.net>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+#
+# Throughput of the pipe and shared-memory ring transports. A forked child
+# emits binary frames as fast as it can, the parent decodes and records
+# them. Reports metrics/sec end to end.
+#
+#   python2 bench/bench_ring.py [metrics]
+#
+
+import os, select, sys, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from squib import metrics, ringbuffer, wire
+
+BATCH = 1000
+
+##############################################################################
+
+def child (emitter, count):
+    for i in xrange(count):
+        emitter.emit('bench.m%d' % (i % BATCH), i, 'gauge')
+        if i % BATCH == BATCH - 1:
+            emitter.flush()
+    emitter.flush()
+    sys.stdout.close()
+    os._exit(0)
+
+def run (make_emitter, on_readable, count):
+    rfd, wfd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(rfd)
+        os.dup2(wfd, 1)
+        child(make_emitter(), count)
+
+    os.close(wfd)
+    start = time.time()
+    while True:
+        select.select([rfd], [], [])
+        data = os.read(rfd, 65536)
+        on_readable(data)
+        if not data:
+            break
+    elapsed = time.time() - start
+    os.waitpid(pid, 0)
+    os.close(rfd)
+    return elapsed
+
+def bench (count):
+    recorder = metrics.MetricsRecorder(prefix='bench.')
+    decoder = wire.FrameDecoder(recorder)
+    elapsed = run(wire.BinaryEmitter, decoder.feed, count)
+    print "pipe: %d metrics in %.3f seconds: %d metrics/sec" % (count, elapsed, count / elapsed)
+
+    recorder = metrics.MetricsRecorder(prefix='bench.')
+    decoder = wire.FrameDecoder(recorder)
+    ring = ringbuffer.RingBuffer(1048576)
+    def drain (data):
+        data = ring.read()
+        if data:
+            decoder.feed(data)
+    elapsed = run(lambda: ringbuffer.RingEmitter(ring), drain, count)
+    print "ring: %d metrics in %.3f seconds: %d metrics/sec" % (count, elapsed, count / elapsed)
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        count = int(sys.argv[1])
+    else:
+        count = 500000
+    bench(count)
+
+##############################################################################
+## THE END
@@ -0,0 +1,98 @@
+#!/usr/bin/python2
+# vim:set ts=4 sw=4 et nowrap syntax=python ff=unix:
+#
+# Copyright 2011-2018 Mark Crewson <mark@crewson.net>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+#
+# Benchmark for the histogram samples. Feeds one second's worth of updates
+# at 1k, 10k and 100k updates/sec into a full reservoir and reports the
+# share of one CPU that rate would need. LegacySample is the sort-on-every-
+# update reservoir the heap-based ExponentiallyDecayingSample replaced.
+#
+#   python2 bench/bench_sample.py
+#
+
+import math, os, random, sys, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from squib import statistics
+
+##############################################################################
+
+class LegacySample (statistics.Sample):
+
+    rescale_threshold = 60 * 60 # 1 hour
+
+    def __init__ (self, reservoirSize, alpha):
+        super(LegacySample, self).__init__(reservoirSize)
+        self.alpha = alpha
+        self.reservoir = []
+        self.starttime = int(time.time())
+        self.next_rescale_time = self.starttime + LegacySample.rescale_threshold
+
+    def update (self, value):
+        now = int(time.time())
+        priority = math.exp(self.alpha * (now - self.starttime)) / random.random()
+        val = (priority, value)
+        self.count += 1
+        if self.count <= self.reservoirSize:
+            self.reservoir.append(val)
+        else:
+            first = self.reservoir[0][0]
+            if first < priority:
+                self.reservoir.append(val)
+                del self.reservoir[0]
+        self.reservoir.sort()
+
+        if now > self.next_rescale_time:
+            self.rescale(now)
+
+    def rescale (self, now):
+        self.next_rescale_time = now + LegacySample.rescale_threshold
+        new_reservoir = []
+        old_starttime = self.starttime
+        self.starttime = now
+        for priority,value in self.reservoir:
+            new_reservoir.append((priority * math.exp(-self.alpha * (self.starttime - old_starttime)), value))
+        self.reservoir = new_reservoir
+
+    def values (self):
+        return [ v for p,v in self.reservoir ]
+
+##############################################################################
+
+RATES = (1000, 10000, 100000)
+
+def bench (klass, rate):
+    sample = klass(1028, statistics.M5_ALPHA)
+    for i in xrange(2056):
+        sample.update(random.randint(0, 100000))
+    values = [ random.randint(0, 100000) for i in xrange(rate) ]
+    update = sample.update
+    start = time.time()
+    for v in values:
+        update(v)
+    return time.time() - start
+
+if __name__ == "__main__":
+    for rate in RATES:
+        for klass in (LegacySample, statistics.ExponentiallyDecayingSample):
+            elapsed = bench(klass, rate)
+            print "%-28s %6d updates/sec: %7.2f usec/update, %6.1f%% of a CPU" % (
+                klass.__name__, rate, elapsed / rate * 1000000, elapsed * 100)
+
+##############################################################################
+## THE END
@@ -0,0 +1,105 @@
+#!/usr/bin/python2
+# vim:set ts=4 sw=4 et nowrap syntax=python ff=unix:
+#
+# Copyright 2011-2018 Mark Crewson <mark@crewson.net>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+#
+# Compares the text and binary oxidizer wire protocols. Each second of
+# traffic is 100k metrics; the child side encodes them, the parent side
+# decodes and records them. Reports the CPU seconds each side spends per
+# second of traffic.
+#
+#   python2 bench/bench_wire.py [seconds]
+#
+
+import os, sys, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from squib import metrics, oxidizer, wire
+
+RATE = 100000
+CHUNK = 4096
+
+##############################################################################
+
+def traffic ():
+    out = []
+    for i in xrange(RATE):
+        if i % 3 == 0:
+            out.append(('bench.be%d.scur' % (i % 5000), i, 'gauge'))
+        elif i % 3 == 1:
+            out.append(('bench.if%d.rpackets' % (i % 5000), 1, 'meter'))
+        else:
+            out.append(('bench.cpu%d' % (i % 5000), i / 7.0, None))
+    return out
+
+def chunks (data):
+    return [ data[i:i+CHUNK] for i in xrange(0, len(data), CHUNK) ]
+
+def encode_text (metrics_list):
+    lines = []
+    for name, value, mtype in metrics_list:
+        if mtype is None:
+            lines.append('%s %s\n' % (name, value))
+        else:
+            lines.append('%s %s %s\n' % (name, mtype, value))
+    return ''.join(lines)
+
+def encode_binary (encoder, metrics_list):
+    frames = []
+    for name, value, mtype in metrics_list:
+        encoder.encode(frames, name, value, mtype)
+    return ''.join(frames)
+
+def bench (seconds):
+    metrics_list = traffic()
+
+    recorder = metrics.MetricsRecorder(prefix='bench.')
+    reader = oxidizer.MetricsReader(recorder)
+    encode_time = decode_time = 0.0
+    for s in xrange(seconds):
+        start = time.time()
+        data = encode_text(metrics_list)
+        encode_time += time.time() - start
+        start = time.time()
+        for c in chunks(data):
+            reader.on_data_read(c)
+        decode_time += time.time() - start
+    print "text:   child %.3f cpu-sec/sec, parent %.3f cpu-sec/sec" % (encode_time / seconds, decode_time / seconds)
+
+    recorder = metrics.MetricsRecorder(prefix='bench.')
+    decoder = wire.FrameDecoder(recorder)
+    encoder = wire.FrameEncoder()
+    encode_time = decode_time = 0.0
+    for s in xrange(seconds):
+        start = time.time()
+        data = encode_binary(encoder, metrics_list)
+        encode_time += time.time() - start
+        start = time.time()
+        for c in chunks(data):
+            decoder.feed(c)
+        decode_time += time.time() - start
+    print "binary: child %.3f cpu-sec/sec, parent %.3f cpu-sec/sec" % (encode_time / seconds, decode_time / seconds)
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        seconds = int(sys.argv[1])
+    else:
+        seconds = 5
+    bench(seconds)
+
+##############################################################################
+## THE END
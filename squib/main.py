@@ -22,7 +22,7 @@ from mccorelib.async             import free_reactor
 from mccorelib.config            import Config, ConfigError
 from mccorelib.log               import getlog
 from mccorelib.multiproc         import ParentController, ParentStates
-from mccorelib.string_conversion import convert_to_bool, ConversionError
+from mccorelib.string_conversion import convert_to_bool, convert_to_integer, convert_to_seconds, ConversionError
 
 from squib import metrics, oxidizer, reporter, selfstats, statistics, utility
 
@@ -71,8 +71,31 @@ class SquibMain (Application):
         if '.' in hostname:
             hostname = hostname.split('.', 1)[0]
         save_file = self.config.get('common::metrics_save_file', None)
+        max_metrics = self.get_metrics_limit('max_metrics')
+        max_metrics_per_prefix = self.get_metrics_limit('max_metrics_per_prefix')
+        metrics_ttl = self.config.get('common::metrics_ttl', None)
+        if metrics_ttl is not None:
+            try:
+                metrics_ttl = convert_to_seconds(metrics_ttl) or None
+            except ConversionError:
+                raise ConfigError('common::metrics_ttl must be a time period')
         self.metrics_recorder = metrics.MetricsRecorder(prefix='%s.' % hostname,
-                                                        save_file=save_file)
+                                                        save_file=save_file,
+                                                        max_metrics=max_metrics,
+                                                        max_metrics_per_prefix=max_metrics_per_prefix,
+                                                        metrics_ttl=metrics_ttl)
+
+    def get_metrics_limit (self, option):
+        limit = self.config.get('common::%s' % option, None)
+        if limit is None:
+            return None
+        try:
+            limit = convert_to_integer(limit)
+        except ConversionError:
+            raise ConfigError('common::%s must be an integer' % option)
+        if limit < 0:
+            raise ConfigError('common::%s must not be negative' % option)
+        return limit or None
 
     def configure_reporter (self):
         try:
@@ -86,8 +109,39 @@ class SquibMain (Application):
                 self.log.warning('No report class defined. Falling back to SimpleLogReporter.')
                 self.reporter = reporter.SimpleLogReporter(None, self.metrics_recorder)
             else:
-                klass = utility.find_python_object(reporter_klass)
-                self.reporter = klass(reporter_config, self.metrics_recorder)
+                self.reporter = self.create_reporter(reporter_config)
+
+    def create_reporter (self, reporter_config, name=None, parents=()):
+        # A child reporter is told its name, if it takes one. Reporters
+        # written before composites do not.
+        klass = utility.find_python_object(reporter_config.get('class'))
+        kw = {}
+        if name is not None and utility.accepts_keyword(klass, 'name'):
+            kw['name'] = name
+        if not (isinstance(klass, type) and issubclass(klass, reporter.CompositeReporter)):
+            return klass(reporter_config, self.metrics_recorder, **kw)
+
+        # The children of a composite reporter have sections of their own.
+        # They report on the composite's schedule.
+        section = name or 'reporter'
+        parents = parents + (section,)
+        children = []
+        for child_name in reporter_config.get('reporters', '').split(','):
+            child_name = child_name.strip()
+            if not child_name: continue
+            if child_name in parents:
+                raise ConfigError('%s::reporters must not name a reporter that contains it: %s' % (section, child_name))
+            try:
+                child_config = self.config.section(child_name)
+            except KeyError:
+                raise ConfigError('No configuration for a reporter named "%s"' % child_name)
+            if child_config.get('class') is None:
+                raise ConfigError('%s::class must be specified' % child_name)
+            for option in ('period', 'changes_only', 'heartbeat'):
+                if child_config.get(option) is not None:
+                    raise ConfigError('%s::%s cannot be set: %s reports on the schedule of %s' % (child_name, option, child_name, section))
+            children.append((child_name, self.create_reporter(child_config, child_name, parents)))
+        return klass(reporter_config, self.metrics_recorder, children=children, **kw)
 
     def configure_oxidizers (self):
         self.controller = SquibController(self.reporter)
@@ -101,7 +155,7 @@ class SquibMain (Application):
                 continue
 
             try:
-                self.controller.add_child(oxidizer.create_oxidizer(ox, oxconfig, self.metrics_recorder))
+                self.controller.add_oxidizer(oxidizer.create_oxidizer(ox, oxconfig, self.metrics_recorder))
             except ConfigError, err:
                 self.log.warn(str(err))
                 self.log.warn("Invalid oxidizer named \"%s\". Ignored" % (ox))
@@ -130,7 +184,7 @@ class SquibMain (Application):
                     self.log.warn("Invalid configuration file %s: no [oxidizer] section" % oxfile)
                     continue
 
-                self.controller.add_child(oxidizer.create_oxidizer(oxname, oxconfig, self.metrics_recorder))
+                self.controller.add_oxidizer(oxidizer.create_oxidizer(oxname, oxconfig, self.metrics_recorder))
             except ConfigError, err:
                 self.log.warn(str(err))
                 self.log.warn("Invalid oxidizer named \"%s\" (from file: %s). Ingored" % (oxname, oxfile))
@@ -207,10 +261,27 @@ class SquibController (ParentController):
         super(SquibController, self).__init__(**kw)
         self.reporter = reporter
         self.report_period = self.reporter.get_report_period()
+        self.inprocess_oxidizers = []
+        self.oxidizer_groups = {}
+
+    def add_oxidizer (self, ox):
+        if isinstance(ox, oxidizer.InProcessOxidizer):
+            self.inprocess_oxidizers.append(ox)
+        elif isinstance(ox, oxidizer.GroupedOxidizer):
+            group = self.oxidizer_groups.get(ox.group)
+            if group is None:
+                group = oxidizer.OxidizerGroup('group:%s' % ox.group, {}, ox.metrics_recorder)
+                self.oxidizer_groups[ox.group] = group
+                self.add_child(group)
+            group.add_member(ox)
+        else:
+            self.add_child(ox)
 
     def setup (self):
         self.reactor.call_later(self.report_period, self.report)
         statistics.schedule_ewma_decay()
+        for ox in self.inprocess_oxidizers:
+            ox.start()
 
     def report (self):
         try:
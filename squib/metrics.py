@@ -14,12 +14,12 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import math, platform, time
+import heapq, itertools, math, operator, platform, time
 
 from mccorelib.baseobject        import NonStdlibError
 from mccorelib.application       import OperationError
 from mccorelib.log               import getlog
-from mccorelib.string_conversion import ConversionError, convert_to_integer
+from mccorelib.string_conversion import ConversionError, convert_to_integer, convert_to_seconds
 from squib                       import statistics
 
 try:
@@ -43,14 +43,43 @@ else:
 
 ##############################################################################
 
+def numeric_value (value):
+    # The number in a value string, or None
+    try:
+        return int(value, 10)
+    except ValueError:
+        try:
+            return float(value)
+        except ValueError:
+            return None
+
+##############################################################################
+
 class MetricsRecorder (object):
 
-    def __init__ (self, prefix="", save_file=None):
+    max_refused_metrics = 10000 # cached
+
+    def __init__ (self, prefix="", save_file=None, max_metrics=None, max_metrics_per_prefix=None,
+                  metrics_ttl=None):
         self.log = getlog()
         self.prefix = prefix
         self.save_file = save_file
+        self.max_metrics = max_metrics
+        self.max_metrics_per_prefix = max_metrics_per_prefix
+        self.metrics_ttl = metrics_ttl
         self.saved_metrics = None
         self.all_metrics = {}
+        self.metric_cache = {}
+        self.type_specs = {}
+        self.prefix_counts = {}
+        self.refused_metrics = 0
+        self.generation = 0
+        self.index = []
+        self.index_added = []
+        self.index_removed = set()
+        self.expiry_heap = []
+        self.last_publish = 0.0
+        self.partial_publishes = 0
         self.selfstats = None
         self.load_saved_metrics()
 
@@ -58,83 +87,390 @@ class MetricsRecorder (object):
         self.selfstats = selfstats
 
     def record (self, name, value):
-        mtype, mtype_args, pvalue = self.parse_value(value)
+        m, pvalue = self.find_metric(name, value)
+        if m is None:
+            return
+
+        if self.selfstats is not None:
+            self.selfstats.mark_metrics_record()
+        m.update(pvalue)
+        m.last_update = time.time()
+
+    def record_many (self, lines, ttl=None):
+        # Batch version of record(), taking raw "name value" lines. The
+        # lookups and the selfstats bookkeeping are done once per batch.
+        # New metrics get the given ttl instead of the recorder's. A line
+        # with an invalid value is logged and skipped, and the rest of the
+        # batch is still recorded.
+        find_metric = self.find_metric
+        now = time.time()
+        recorded = 0
+        for line in lines:
+            if not line: continue
+            name, sep, value = line.partition(' ')
+            if not sep:
+                self.log.warning('Invalid metric: %s' % line)
+                continue
+
+            m, pvalue = find_metric(name, value, ttl)
+            if m is None:
+                continue
+
+            try:
+                m.update(pvalue)
+            except Exception, why:
+                self.log.warning('Ignored invalid value for metric %s: %s' % (name, str(why)))
+                continue
+            m.last_update = now
+            recorded += 1
+
+        if recorded and self.selfstats is not None:
+            self.selfstats.mark_metrics_record(recorded)
+
+    def mark_recorded (self, count):
+        # For callers that update metrics directly, after a lookup_metric().
+        # Those callers must also set the metric's last_update. When the
+        # recorder's generation changes they must drop the metrics they
+        # hold, and look each one up again only when it is next updated.
+        # Looking them all up at once would bring evicted and expired
+        # metrics back.
+        if self.selfstats is not None:
+            self.selfstats.mark_metrics_record(count)
+
+    def find_metric (self, name, value, ttl=None):
+        # The metric a "[type] value" string is recorded in, and the value
+        # to update it with. A bare value is a gauge, if it is a number.
+        # Returns None for values that cannot be recorded.
+        mtype_string, sep, pvalue = value.partition(' ')
+        if not sep:
+            try:
+                float(value)
+            except ValueError:
+                self.log.warn("Ignored invalid metric: \"%s %s\"" % (name, value))
+                return None, None
+            mtype_string, pvalue = '', value
+
+        m = self.metric_cache.get((name, mtype_string))
+        if m is None:
+            m, pvalue = self.resolve_metric(name, mtype_string, value, pvalue, ttl)
+        if m.__class__ is InvalidMetric:
+            return None, None
+        return m, pvalue
+
+    def lookup_metric (self, name, mtype_string, ttl=None):
+        m = self.metric_cache.get((name, mtype_string))
+        if m is None:
+            m, _pvalue = self.resolve_metric(name, mtype_string, mtype_string, '', ttl)
+        return m
+
+    def resolve_metric (self, name, mtype_string, value, pvalue, ttl=None):
+        # Slow path of record(): find (or create) the metric for a
+        # (name, type token) pair seen for the first time, and cache it
+        # so that subsequent lines are a single dictionary lookup. An
+        # empty type token is a gauge.
+        if mtype_string:
+            spec = self.parse_type(mtype_string)
+        else:
+            spec = (GaugeMetric, None)
+        if spec is None:
+            # with no explicit metric type specified, default
+            # to a gauge if the value is just a number
+            try:
+                float(value)
+            except ValueError:
+                # Not cached: the leading word of an invalid value is
+                # rarely a type, and caching it would only fill the cache
+                self.log.warn("Ignored invalid metric: \"%s %s\"" % (name, value))
+                return InvalidMetric(name), pvalue
+            mtype_string, pvalue = '', value
+            spec = (GaugeMetric, None)
 
+        mtype, mtype_args = spec
         full_name = "%s:%s:%s" % (name, mtype.__name__, mtype_args)
         m = self.all_metrics.get(full_name)
         if m is None:
             # New metric. Create it
-            if mtype is None:
-                self.log.warn("Ignored invalid metric: \"%s %s\"" % (name, value))
-                self.all_metrics[full_name] = InvalidMetric(name)
-                return
-
+            if not self.admit_metric(name):
+                self.refuse_metric(name, mtype_string)
+                return OVERFLOW_METRIC, pvalue
             try:
                 if mtype_args is None:
                     m = mtype(name)
                 else:
-                    m = mtype(name, *mtype_args)
+                    m = mtype(name, *mtype_args.split(','))
                 self.restore_metric(m, full_name)
             except MetricError:
                 self.log.warn("Ignored invalid metric: \"%s %s\"" % (name, value))
-                self.all_metrics[full_name] = InvalidMetric(name)
-                return
+                m = InvalidMetric(name)
+            if ttl is not None:
+                m.ttl = ttl
+            self.add_metric(full_name, m)
+
+        self.metric_cache[(name, mtype_string)] = m
+        return m, pvalue
+
+    def admit_metric (self, name):
+        if self.max_metrics_per_prefix:
+            prefix = name.split('.', 1)[0]
+            if self.prefix_counts.get(prefix, 0) >= self.max_metrics_per_prefix:
+                return False
+        if self.max_metrics and len(self.all_metrics) >= self.max_metrics:
+            # Make a little headroom, so that eviction is not done for
+            # every single new metric once the recorder is full
+            self.evict_metrics(len(self.all_metrics) - self.max_metrics + max(1, self.max_metrics // 20))
+        return True
+
+    def refuse_metric (self, name, mtype_string):
+        # Refused metrics are cached too, so that each one takes the slow
+        # path, and counts as an overflow, only once. They are forgotten
+        # when metrics are removed, and there may be room for them again,
+        # or when too many of them pile up.
+        if self.refused_metrics >= self.max_refused_metrics:
+            self.metric_cache = dict([ (key, m) for key, m in self.metric_cache.iteritems()
+                                                if m is not OVERFLOW_METRIC ])
+            self.refused_metrics = 0
+        self.metric_cache[(name, mtype_string)] = OVERFLOW_METRIC
+        self.refused_metrics += 1
+        if self.selfstats is not None:
+            self.selfstats.mark_metrics_overflow()
+
+    def add_metric (self, full_name, m):
+        self.all_metrics[full_name] = m
+        self.index_added.append(m)
+        prefix = m.name.split('.', 1)[0]
+        self.prefix_counts[prefix] = self.prefix_counts.get(prefix, 0) + 1
+        ttl = m.ttl or self.metrics_ttl
+        if ttl:
+            heapq.heappush(self.expiry_heap, (m.last_update + ttl, full_name, m))
+
+    def evict_metrics (self, count):
+        # Evict the least recently updated metrics
+        oldest = heapq.nsmallest(count, self.all_metrics.iteritems(), key=lambda item: item[1].last_update)
+        self.remove_metrics([ full_name for full_name, m in oldest ])
+        if self.selfstats is not None:
+            self.selfstats.mark_metrics_evicted(len(oldest))
+
+    def remove_metrics (self, full_names):
+        removed = set()
+        for full_name in full_names:
+            m = self.all_metrics.pop(full_name, None)
+            if m is None: continue
+            m.close()
+            removed.add(id(m))
+            if self.saved_metrics is not None:
+                # Do not bring it back from the dead, should it return
+                self.saved_metrics.pop(full_name, None)
+            prefix = m.name.split('.', 1)[0]
+            self.prefix_counts[prefix] -= 1
+            if self.prefix_counts[prefix] <= 0:
+                del self.prefix_counts[prefix]
+
+        if removed:
+            self.index_removed.update(removed)
+            self.metric_cache = dict([ (key, m) for key, m in self.metric_cache.iteritems()
+                                                if id(m) not in removed and m is not OVERFLOW_METRIC ])
+            self.refused_metrics = 0
+            # Anyone holding on to metric objects must let go of them
+            self.generation += 1
+            if len(self.expiry_heap) > 2 * len(self.all_metrics) + 1024:
+                # Most of the heap is removed metrics, not yet due
+                all_metrics = self.all_metrics
+                self.expiry_heap = [ entry for entry in self.expiry_heap if all_metrics.get(entry[1]) is entry[2] ]
+                heapq.heapify(self.expiry_heap)
+
+    def parse_type (self, mtype_string):
+        try:
+            return self.type_specs[mtype_string]
+        except KeyError:
+            pass
 
-            self.all_metrics[full_name] = m
+        mtype_lower = mtype_string.lower()
+        mtype_args = None
+        paren_open = mtype_lower.find('(')
+        paren_clos = mtype_lower.find(')')
+        if paren_open >= 0 and paren_clos >= 0 and paren_clos > paren_open+1:
+            mtype_args = mtype_lower[paren_open+1:paren_clos]
+            mtype_lower = mtype_lower[:paren_open]
 
-        elif isinstance(m, InvalidMetric):
-            return
+        mtype = METRIC_TYPES.get(mtype_lower)
+        if mtype is None:
+            # Not a metric type. Do not cache it, these are usually values
+            return None
 
-        if self.selfstats is not None:
-            self.selfstats.mark_metrics_record()
-        m.update(pvalue)
+        spec = (mtype, mtype_args)
+        self.type_specs[mtype_string] = spec
+        return spec
 
     def parse_value (self, value_string):
-        value_parts = value_string.split(' ')
-        mtype_string = value_parts[0].lower()
-
-        mtype_args = None
-        paren_open = mtype_string.find('(')
-        paren_clos = mtype_string.find(')')
-        if paren_open >= 0 and paren_clos >= 0 and paren_clos > paren_open+1:
-            mtype_args = mtype_string[paren_open+1:paren_clos]
-            mtype_string = mtype_string[:paren_open]
-
-        if mtype_string == 'string':
-            mtype = StringMetric
-        elif mtype_string == 'gauge':
-            mtype = GaugeMetric
-        elif mtype_string in ('counter', 'cnt'):
-            mtype = CounterMetric
-        elif mtype_string == 'derivgauge':
-            mtype = DerivativeGaugeMetric
-        elif mtype_string == 'meter':
-            mtype = MeterMetric
-        elif mtype_string == 'derivmeter':
-            mtype = DerivativeMeterMetric
-        elif mtype_string in ('histogram', 'hist'):
-            mtype = HistogramMetric
-        else:
-            # with no explicit metric type specified, default
-            # to a gauge if the value_string is just a integer
+        mtype_string, _sep, pvalue = value_string.partition(' ')
+        spec = self.parse_type(mtype_string)
+        if spec is None:
             try:
                 float(value_string)
                 return GaugeMetric, None, value_string
             except ValueError:
                 return None, None, value_string
-
-        return mtype, mtype_args, ' '.join(value_parts[1:])
-
-    def publish (self):
+        return spec[0], spec[1], pvalue
+
+    def expire_metrics (self, now):
+        # Metrics with a ttl are kept in a heap by the time they were due to
+        # expire when last looked at. Only the entries that are due now are
+        # popped. A metric updated since is pushed back with its new time.
+        heap = self.expiry_heap
+        all_metrics = self.all_metrics
+        metrics_ttl = self.metrics_ttl
+        expired = []
+        while heap and heap[0][0] < now:
+            _due, full_name, m = heapq.heappop(heap)
+            if all_metrics.get(full_name) is not m:
+                # Removed already
+                continue
+            due = m.last_update + (m.ttl or metrics_ttl)
+            if due < now:
+                expired.append(full_name)
+            else:
+                heapq.heappush(heap, (due, full_name, m))
+        if expired:
+            self.remove_metrics(expired)
+            if self.selfstats is not None:
+                self.selfstats.mark_metrics_expired(len(expired))
+
+    def update_index (self):
+        # The index is the list of metrics sorted by name. It is only
+        # touched when metrics were added or removed since the last publish.
+        index = self.index
+        added = self.index_added
+        removed = self.index_removed
+        if removed:
+            index = [ m for m in index if id(m) not in removed ]
+            added = [ m for m in added if id(m) not in removed ]
+            self.index_removed = set()
+        if added:
+            # The sort finds the sorted run and merges the new metrics in
+            index.extend(added)
+            index.sort(key=operator.attrgetter('name'))
+        self.index_added = []
+        self.index = index
+
+    def start_publish (self):
         if self.selfstats is not None:
             self.selfstats.mark_metrics_report()
-        epoch = int(time.time())
-        lines = []
-        allm = self.all_metrics.values()[:]
-        allm.sort()
-        for m in allm:
-            m.report(lines, self.prefix, epoch)
-        return lines
+        now = time.time()
+        self.expire_metrics(now)
+        self.update_index()
+        return now
+
+    def select_metrics (self, changes_only=False):
+        # The metrics of a report, in name order, with fresh report values.
+        # Metrics that were not updated since the last publish, and whose
+        # report does not change with time alone, keep their last values.
+        # With changes_only, metrics whose values did not change are left
+        # out.
+        now = self.start_publish()
+        last_publish = self.last_publish
+        if changes_only:
+            selected = [ m for m in self.index
+                         if (m.values is None or m.volatile or m.last_update >= last_publish) and m.refresh() ]
+        else:
+            selected = list(self.index)
+            for m in selected:
+                if m.values is None or m.volatile or m.last_update >= last_publish:
+                    m.refresh()
+        self.last_publish = now
+        return selected, int(now)
+
+    def metrics_text (self, selected, epoch, numeric_only=False, selected_values=None):
+        # The report lines of the selected metrics as a single string of
+        # newline terminated lines. Each metric's block is its class's
+        # template formatted with its values, with the name put in front of
+        # every line. The blocks are joined, and the timestamps added, in
+        # one pass each over a single output string. selected_values are
+        # the values of the selected metrics as of an earlier publish.
+        if selected_values is None:
+            selected_values = map(METRIC_VALUES, selected)
+        prefix = self.prefix
+        templates = REPORT_TEMPLATES
+        blocks = []
+        append = blocks.append
+        for m, values in itertools.izip(selected, selected_values):
+            if not values or (numeric_only and not m.numeric):
+                continue
+            block = (templates.get(m.__class__) or report_template(m.__class__)) % values
+            if '\n' in block:
+                stem = prefix + m.name
+                append(stem + block.replace('\n', '\n' + stem))
+            else:
+                append(prefix + m.name + block)
+        if not blocks:
+            return ''
+        blocks.append('')
+        return '\n'.join(blocks).replace('\n', ' %d\n' % epoch)
+
+    def metrics_datapoints (self, selected, epoch, selected_values=None):
+        # (path, (timestamp, value)) for every numeric report field of the
+        # selected metrics, taken straight from their values. Gauges
+        # recorded from text keep the text, and are sent as numbers. Values
+        # that are not numbers are left out.
+        if selected_values is None:
+            selected_values = map(METRIC_VALUES, selected)
+        prefix = self.prefix
+        datapoints = []
+        append = datapoints.append
+        skipped = 0
+        for m, values in itertools.izip(selected, selected_values):
+            if not m.numeric or not values:
+                continue
+            stem = prefix + m.name + '.'
+            for (field, _fmt), value in zip(m.report_fields, values):
+                if value.__class__ is str:
+                    value = numeric_value(value)
+                    if value is None:
+                        skipped += 1
+                        continue
+                append((stem + field, (epoch, value)))
+        if skipped:
+            self.log.warning('Left %d values that are not numbers out of the report' % skipped)
+        return datapoints
+
+    def want_changes_only (self, heartbeat):
+        # Every heartbeat'th publish is a full report, so that series which
+        # never change are still sent now and then.
+        self.partial_publishes += 1
+        if heartbeat and self.partial_publishes >= heartbeat:
+            self.partial_publishes = 0
+            return False
+        return True
+
+    def want_changes (self, changes_only, heartbeat):
+        if changes_only:
+            return self.want_changes_only(heartbeat)
+        self.partial_publishes = 0
+        return False
+
+    def publish_metrics (self, changes_only=False, heartbeat=None):
+        # The metrics of a report and its timestamp. With changes_only,
+        # only the metrics whose report changed since the last publish are
+        # included, and every heartbeat'th publish is a full one.
+        return self.select_metrics(self.want_changes(changes_only, heartbeat))
+
+    def publish_text (self, changes_only=False, heartbeat=None, numeric_only=False):
+        # The whole report as a single string of newline terminated lines.
+        # With numeric_only, string metrics are left out.
+        selected, epoch = self.publish_metrics(changes_only, heartbeat)
+        return self.metrics_text(selected, epoch, numeric_only)
+
+    def publish (self, changes_only=False, heartbeat=None, numeric_only=False):
+        return self.publish_text(changes_only, heartbeat, numeric_only).splitlines()
+
+    def publish_datapoints (self, changes_only=False, heartbeat=None):
+        selected, epoch = self.publish_metrics(changes_only, heartbeat)
+        return self.metrics_datapoints(selected, epoch)
+
+    def republish_text (self, epoch, numeric_only=False):
+        # The full report of the last publish, even one with changes_only,
+        # from the values every metric had as of then
+        selected = [ m for m in self.index if m.values is not None ]
+        return self.metrics_text(selected, epoch, numeric_only)
 
     def save (self):
         if self.save_file is None: return
@@ -144,9 +480,9 @@ class MetricsRecorder (object):
                   'timestamp %s' % epoch,
                 ]
         for mname, metric in self.all_metrics.items():
-            mdata = json_encode(metric.save())
+            mdata = metric.save()
             if mdata is None: continue
-            lines.append('%s %s' % (mname, mdata))
+            lines.append('%s %s' % (mname, json_encode(mdata)))
         try:
             fp = open(self.save_file, 'w')
             fp.write('\n'.join(lines) + '\n')
@@ -196,12 +532,51 @@ class MetricsRecorder (object):
 
 ##############################################################################
 
+#
+# There can be a great many metric objects, so every metric class declares
+# __slots__ to do without a per-instance __dict__. Mixins (DerivativeMetric)
+# declare no slots of their own; the concrete classes using them declare
+# the mixin's fields instead.
+#
+
+# The report lines of every metric class, without the metric's name
+REPORT_TEMPLATES = {}
+
+METRIC_VALUES = operator.attrgetter('values')
+
+def report_template (klass):
+    # One ".<field> <format>" line per report field, shared by every metric
+    # of the class
+    template = REPORT_TEMPLATES.get(klass)
+    if template is None:
+        template = '\n'.join([ '.%s %s' % (field, fmt) for field, fmt in klass.report_fields ])
+        REPORT_TEMPLATES[klass] = template
+    return template
+
 class BaseMetric (object):
 
+    # The values of the last report are kept until they change
+    __slots__ = ('name', 'last_update', 'ttl', 'values')
+
+    # True if the report changes with time alone, without any update
+    volatile = False
+
+    # False if the report values are not numbers
+    numeric = True
+
+    # One report line per (field, format): "<prefix><name>.<field> <value>"
+    report_fields = ()
+
     def __init__ (self, name, *args):
         self.name = name
+        self.last_update = time.time()
+        self.ttl = None
+        self.values = None
         self.parse_args(args)
-        self.log = getlog()
+
+    @property
+    def log (self):
+        return getlog()
 
     def __cmp__ (self, other):
         return cmp(self.name, other.name)
@@ -212,41 +587,91 @@ class BaseMetric (object):
     def update (self, value):
         raise NotImplementedError
 
-    def report (self, lines, prefix, epoch):
+    def update_number (self, value):
+        self.update(str(value))
+
+    def refresh (self):
+        # Takes the report values afresh. True if they changed.
+        values = self.report_values()
+        if values == self.values:
+            return False
+        self.values = values
+        return True
+
+    def render (self, prefix):
+        # The report lines of the values taken by the last refresh(),
+        # newline separated and without their timestamp
+        if not self.values:
+            return ''
+        stem = prefix + self.name
+        return stem + (report_template(self.__class__) % self.values).replace('\n', '\n' + stem)
+
+    def report_values (self):
+        # A tuple of values for the report_fields
         raise NotImplementedError
 
+    def report (self, lines, prefix, epoch):
+        self.refresh()
+        rendered = self.render(prefix)
+        if rendered:
+            suffix = ' %d' % epoch
+            for line in rendered.split('\n'):
+                lines.append(line + suffix)
+
     def save (self):
         return None
 
     def load (self, metric_data, timestamp):
         pass
 
+    def close (self):
+        pass
+
 ##############################################################################
 
 class InvalidMetric (BaseMetric):
+    __slots__ = ()
     def update (self, value):
         pass
-    def report (self, lines, prefix, epoch):
+    def update_number (self, value):
         pass
+    def report_values (self):
+        return ()
+
+# Stands in for new metrics that were refused for being over budget
+OVERFLOW_METRIC = InvalidMetric('<overflow>')
 
 ##############################################################################
 
 class StringMetric (BaseMetric):
 
+    __slots__ = ('value',)
+
+    numeric = False
+
+    report_fields = (('string', '"%s"'),)
+
     def __init__ (self, name, *args):
         super(StringMetric, self).__init__(name, *args)
         self.value = 0
 
     def update (self, value):
+        # A line break would split the value's report line in two
+        if '\n' in value or '\r' in value:
+            value = value.replace('\r', '\\r').replace('\n', '\\n')
         self.value = value
 
-    def report (self, lines, prefix, epoch):
-        lines.append("%s%s.string \"%s\" %d" % (prefix, self.name, self.value, epoch))
+    def report_values (self):
+        return (self.value,)
 
 ##############################################################################
 
 class GaugeMetric (BaseMetric):
 
+    __slots__ = ('value',)
+
+    report_fields = (('value', '%s'),)
+
     def __init__ (self, name, *args):
         super(GaugeMetric, self).__init__(name, *args)
         self.value = 0
@@ -254,8 +679,10 @@ class GaugeMetric (BaseMetric):
     def update (self, value):
         self.value = value
 
-    def report (self, lines, prefix, epoch):
-        lines.append("%s%s.value %s %d" % (prefix, self.name, self.value, epoch))
+    update_number = update
+
+    def report_values (self):
+        return (self.value,)
 
     def save (self):
         return { 'value': self.value }
@@ -267,6 +694,10 @@ class GaugeMetric (BaseMetric):
 
 class CounterMetric (BaseMetric):
 
+    __slots__ = ('count',)
+
+    report_fields = (('count', '%d'),)
+
     def __init__ (self, name, *args):
         super(CounterMetric, self).__init__(name, *args)
         self.count = 0
@@ -279,8 +710,11 @@ class CounterMetric (BaseMetric):
         else:
             self.count += int(value, 10)
 
-    def report (self, lines, prefix, epoch):
-        lines.append("%s%s.count %d %d" % (prefix, self.name, self.count, epoch))
+    def update_number (self, value):
+        self.count += int(value)
+
+    def report_values (self):
+        return (self.count,)
 
     def save (self):
         return { 'count': self.count }
@@ -292,6 +726,8 @@ class CounterMetric (BaseMetric):
 
 class DerivativeMetric (BaseMetric):
 
+    __slots__ = () # 'last_value' and 'max_value' in subclasses
+
     def __init__ (self, name, *args):
         super(DerivativeMetric, self).__init__(name, *args)
         self.last_value = 0
@@ -306,7 +742,6 @@ class DerivativeMetric (BaseMetric):
                 raise MetricError('max_value must be an integer')
 
     def derivative (self, value):
-        value = int(value, 10)
         if self.last_value == 0:
             result = 0
         else:
@@ -331,6 +766,8 @@ class DerivativeMetric (BaseMetric):
 
 class DerivativeGaugeMetric (GaugeMetric, DerivativeMetric):
 
+    __slots__ = ('last_value', 'max_value', 'last_time')
+
     def __init__ (self, name, *args):
         GaugeMetric.__init__(self, name, *args)
         DerivativeMetric.__init__(self, name, *args)
@@ -346,45 +783,50 @@ class DerivativeGaugeMetric (GaugeMetric, DerivativeMetric):
         return result
         
     def update (self, value):
-        self.value = self.derivative(value)
+        self.value = self.derivative(int(value, 10))
+
+    def update_number (self, value):
+        self.value = self.derivative(int(value))
 
 ##############################################################################
 
 class MeterMetric (BaseMetric):
 
+    __slots__ = ('count', 'start_time', 'rates')
+
+    volatile = True
+    report_fields = (('count', '%d'), ('meanRate', '%2.2f'), ('1minuteRate', '%2.2f'),
+                     ('5minuteRate', '%2.2f'), ('15minuteRate', '%2.2f'))
+
     def __init__ (self, name, *args):
         super(MeterMetric, self).__init__(name, *args)
 
         self.count = 0
         self.start_time = time.time()
 
-        self.m1_rate  = statistics.one_minute_ewma()
-        self.m5_rate  = statistics.five_minute_ewma()
-        self.m15_rate = statistics.fifteen_minute_ewma()
+        # The 1, 5 and 15 minute rates live in the shared EWMA engine
+        self.rates = statistics.meter_rates()
 
     def update (self, value):
         if value[0] == '+':
             cnt = int(value[1:], 10)
         else:
             cnt = int(value, 10)
+        self.mark(cnt)
+
+    def update_number (self, value):
+        self.mark(int(value))
 
+    def mark (self, cnt):
         self.count += cnt
-        self.m1_rate.update(cnt)
-        self.m5_rate.update(cnt)
-        self.m15_rate.update(cnt)
+        self.rates.update(cnt)
 
-    def report (self, lines, prefix, epoch):
-        lines.append("%s%s.count %d %d" % (prefix, self.name, self.count, epoch))
-        lines.append("%s%s.meanRate %2.2f %d" % (prefix, self.name, self.mean_rate(), epoch))
-        m1_val = self.m1_rate.averageValue()
-        if m1_val is not None:
-            lines.append("%s%s.1minuteRate %2.2f %d" % (prefix, self.name, m1_val, epoch))
-        m5_val = self.m5_rate.averageValue()
-        if m5_val is not None:
-            lines.append("%s%s.5minuteRate %2.2f %d" % (prefix, self.name, m5_val, epoch))
-        m15_val = self.m15_rate.averageValue()
-        if m15_val is not None:
-            lines.append("%s%s.15minuteRate %2.2f %d" % (prefix, self.name, m15_val, epoch))
+    def report_values (self):
+        rates = self.rates
+        return (self.count, self.mean_rate(), rates.rate(0), rates.rate(1), rates.rate(2))
+
+    def close (self):
+        self.rates.close()
 
     def mean_rate (self):
         if self.count == 0:
@@ -393,10 +835,11 @@ class MeterMetric (BaseMetric):
             return self.count / (time.time() - self.start_time)
 
     def save (self):
+        uncounted = self.rates.uncounted()
         return { 'count':self.count, 'start_time':self.start_time, 
-                 'm1_rate':self.m1_rate.rate, 'm1_uncounted':self.m1_rate.uncounted,
-                 'm5_rate':self.m5_rate.rate, 'm5_uncounted':self.m5_rate.uncounted,
-                 'm15_rate':self.m15_rate.rate, 'm15_uncounted':self.m15_rate.uncounted, }
+                 'm1_rate':self.rates.rate(0), 'm1_uncounted':uncounted,
+                 'm5_rate':self.rates.rate(1), 'm5_uncounted':uncounted,
+                 'm15_rate':self.rates.rate(2), 'm15_uncounted':uncounted, }
 
     def load (self, data, timestamp):
         self.count = data['count']
@@ -405,16 +848,18 @@ class MeterMetric (BaseMetric):
         # Only load the metrics if they will still have an effect on the current values
         now = int(time.time())
         if now - timestamp < 60:
-            self.m1_rate.initialize(data['m1_rate'], data['m1_uncounted'])
+            self.rates.initialize(0, data['m1_rate'], data['m1_uncounted'])
         if now - timestamp < 300:
-            self.m5_rate.initialize(data['m5_rate'], data['m5_uncounted'])
+            self.rates.initialize(1, data['m5_rate'], data['m5_uncounted'])
         if now - timestamp < 900:
-            self.m15_rate.initialize(data['m15_rate'], data['m15_uncounted'])
+            self.rates.initialize(2, data['m15_rate'], data['m15_uncounted'])
 
 ##############################################################################
 
 class DerivativeMeterMetric (MeterMetric, DerivativeMetric):
 
+    __slots__ = ('last_value', 'max_value')
+
     def __init__ (self, name, *args):
         MeterMetric.__init__(self, name, *args)
         DerivativeMetric.__init__(self, name, *args)
@@ -422,15 +867,31 @@ class DerivativeMeterMetric (MeterMetric, DerivativeMetric):
     def update (self, value):
         if value[0] == '+':
             value = value[1:]
-        cnt = self.derivative(value)
-        self.count += cnt
-        self.m1_rate.update(cnt)
-        self.m5_rate.update(cnt)
-        self.m15_rate.update(cnt)
+        self.mark(self.derivative(int(value, 10)))
+
+    def update_number (self, value):
+        self.mark(self.derivative(int(value)))
 
 ##############################################################################
 
 class HistogramMetric (BaseMetric):
+    """
+    The type arguments choose the sample behind the percentiles:
+
+      hist                             - exponentially decaying sample
+      hist(ddsketch[,accuracy=0.01])   - mergeable DDSketch
+      hist(window=60s)                 - the values of the last 60 seconds
+
+    With a window, the min, max, mean and stddev are of the window too.
+    """
+
+    __slots__ = ('count', 'max_val', 'min_val', 'sum_val', 'variance', 'sample')
+
+    default_sample = 'eds'
+
+    report_fields = (('min', '%2.2f'), ('max', '%2.2f'), ('mean', '%2.2f'), ('stddev', '%2.2f'),
+                     ('median', '%2.2f'), ('75percentile', '%2.2f'), ('95percentile', '%2.2f'),
+                     ('98percentile', '%2.2f'), ('99percentile', '%2.2f'), ('999percentile', '%2.2f'))
 
     def __init__ (self, name, *args):
         super(HistogramMetric, self).__init__(name, *args)
@@ -439,11 +900,61 @@ class HistogramMetric (BaseMetric):
         self.min_val = None
         self.sum_val = 0
         self.variance = (-1, 0)
-        self.sample = statistics.five_minute_eds()
+
+    def parse_args (self, args):
+        kind = None
+        options = {}
+        for arg in args:
+            arg = arg.strip()
+            if not arg: continue
+            if '=' in arg:
+                key, value = arg.split('=', 1)
+                options[key.strip()] = value.strip()
+            else:
+                kind = arg
+        self.sample = self.create_sample(kind, options)
+
+    def create_sample (self, kind, options):
+        if kind is None:
+            kind = self.default_sample
+            if kind == 'eds' and 'window' in options:
+                kind = 'window'
+
+        if kind == 'eds':
+            sample = statistics.five_minute_eds()
+        elif kind == 'window':
+            try:
+                window = convert_to_seconds(options.pop('window', '60s'))
+            except ConversionError:
+                raise MetricError('histogram window must be a time period')
+            if window <= 0:
+                raise MetricError('histogram window must be a time period')
+            sample = statistics.SlidingTimeWindowSample(1028, window)
+        elif kind in ('ddsketch', 'sketch'):
+            accuracy = options.pop('accuracy', None)
+            if accuracy is not None:
+                try:
+                    accuracy = float(accuracy)
+                except ValueError:
+                    raise MetricError('histogram accuracy must be a number')
+                if not 0.0 < accuracy < 1.0:
+                    raise MetricError('histogram accuracy must be between 0 and 1')
+            sample = statistics.DDSketch(accuracy)
+        else:
+            raise MetricError('unknown histogram sample: %s' % kind)
+        if options:
+            raise MetricError('unknown histogram options: %s' % ','.join(options.keys()))
+        return sample
 
     def update (self, value):
-        val = int(value, 10)
+        # Whole numbers stay integers. Durations often are not.
+        try:
+            val = int(value, 10)
+        except ValueError:
+            val = float(value)
+        self.update_number(val)
 
+    def update_number (self, val):
         self.count += 1
         self.sample.update(val)
         self.set_max(val)
@@ -451,18 +962,16 @@ class HistogramMetric (BaseMetric):
         self.sum_val= self.sum_val + val
         self.update_variance(val)
 
-    def report (self, lines, prefix, epoch):
-        percentiles = self.sample.percentiles(0.5, 0.75, 0.95, 0.98, 0.99, 0.999)
-        lines.append("%s%s.min %2.2f %d"          % (prefix, self.name, self.min_rate(), epoch))
-        lines.append("%s%s.max %2.2f %d"          % (prefix, self.name, self.max_rate(), epoch))
-        lines.append("%s%s.mean %2.2f %d"         % (prefix, self.name, self.mean_rate(), epoch))
-        lines.append("%s%s.stddev %2.2f %d"        % (prefix, self.name, self.std_dev(), epoch))
-        lines.append("%s%s.median %2.2f %d"        % (prefix, self.name, percentiles[0], epoch))
-        lines.append("%s%s.75percentile %2.2f %d"  % (prefix, self.name, percentiles[1], epoch))
-        lines.append("%s%s.95percentile %2.2f %d"  % (prefix, self.name, percentiles[2], epoch))
-        lines.append("%s%s.98percentile %2.2f %d"  % (prefix, self.name, percentiles[3], epoch))
-        lines.append("%s%s.99percentile %2.2f %d"  % (prefix, self.name, percentiles[4], epoch))
-        lines.append("%s%s.999percentile %2.2f %d" % (prefix, self.name, percentiles[5], epoch))
+    @property
+    def volatile (self):
+        return self.sample.volatile
+
+    def report_values (self):
+        if self.sample.windowed:
+            summary = self.sample.summary()
+        else:
+            summary = (self.min_rate(), self.max_rate(), self.mean_rate(), self.std_dev())
+        return summary + tuple(self.sample.percentiles(0.5, 0.75, 0.95, 0.98, 0.99, 0.999))
 
     def set_max (self, value):
         if self.max_val is None:
@@ -508,5 +1017,109 @@ class HistogramMetric (BaseMetric):
             return math.sqrt(self.get_variance())
         return 0.0
 
+    def merge (self, other):
+        # Only histograms backed by a mergeable sample (a DDSketch) can be
+        # merged, from another oxidizer or host
+        self.sample.merge(other.sample)
+        if other.count == 0:
+            return
+        if self.count == 0:
+            self.variance = other.variance
+        else:
+            m1, s1 = self.variance
+            m2, s2 = other.variance
+            total = self.count + other.count
+            delta = m2 - m1
+            self.variance = (m1 + delta * other.count / float(total),
+                             s1 + s2 + delta * delta * self.count * other.count / float(total))
+        self.count += other.count
+        self.sum_val += other.sum_val
+        if other.max_val is not None:
+            self.set_max(other.max_val)
+        if other.min_val is not None:
+            self.set_min(other.min_val)
+
+    def save (self):
+        if not hasattr(self.sample, 'to_dict'):
+            return None
+        return { 'count':self.count, 'max':self.max_val, 'min':self.min_val,
+                 'sum':self.sum_val, 'variance':list(self.variance),
+                 'sample':self.sample.to_dict(), }
+
+    def load (self, data, timestamp):
+        sample = self.sample.from_dict(data['sample'])
+        if sample.relative_accuracy != self.sample.relative_accuracy:
+            return
+        self.sample = sample
+        self.count = data['count']
+        self.max_val = data['max']
+        self.min_val = data['min']
+        self.sum_val = data['sum']
+        self.variance = tuple(data['variance'])
+
+##############################################################################
+
+class SketchMetric (HistogramMetric):
+    """
+    A histogram backed by a DDSketch: sketch[(accuracy=0.01)]
+    """
+
+    __slots__ = ()
+
+    default_sample = 'ddsketch'
+
+##############################################################################
+
+class TimerMetric (HistogramMetric):
+    """
+    A histogram of durations that also meters how often they happen. One
+    "timer" line updates both, sharing the event count. Takes the same type
+    arguments as a histogram.
+    """
+
+    __slots__ = ('start_time', 'rates')
+
+    volatile = True
+    report_fields = MeterMetric.report_fields + HistogramMetric.report_fields
+
+    def __init__ (self, name, *args):
+        super(TimerMetric, self).__init__(name, *args)
+        self.start_time = time.time()
+        self.rates = statistics.meter_rates()
+
+    def update_number (self, val):
+        super(TimerMetric, self).update_number(val)
+        self.rates.update(1)
+
+    def report_values (self):
+        rates = self.rates
+        return (self.count, self.event_rate(), rates.rate(0), rates.rate(1), rates.rate(2)) + \
+               super(TimerMetric, self).report_values()
+
+    def event_rate (self):
+        # mean_rate() is the histogram's mean value
+        if self.count == 0:
+            return 0.0
+        return self.count / (time.time() - self.start_time)
+
+    def close (self):
+        self.rates.close()
+
+##############################################################################
+
+METRIC_TYPES = {
+    'string'     : StringMetric,
+    'gauge'      : GaugeMetric,
+    'counter'    : CounterMetric,
+    'cnt'        : CounterMetric,
+    'derivgauge' : DerivativeGaugeMetric,
+    'meter'      : MeterMetric,
+    'derivmeter' : DerivativeMeterMetric,
+    'histogram'  : HistogramMetric,
+    'hist'       : HistogramMetric,
+    'sketch'     : SketchMetric,
+    'timer'      : TimerMetric,
+}
+
 ##############################################################################
 ## THE END
@@ -14,24 +14,42 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import os, traceback
+import os, time, traceback
 
-from mccorelib.async     import ReadOnlyFileDescriptorReactable
-from mccorelib.config    import ConfigError
-from mccorelib.log       import getlog
-from mccorelib.multiproc import ChildController
-from squib.oxidizers.base import BasePythonOxidizer
+from mccorelib.async             import ReadOnlyFileDescriptorReactable, get_reactor
+from mccorelib.config            import ConfigError
+from mccorelib.log               import getlog
+from mccorelib.multiproc         import ChildController
+from mccorelib.string_conversion import convert_to_bool, convert_to_integer, convert_to_seconds, ConversionError
+from squib.oxidizers.base        import BasePythonOxidizer, PeriodicOxidizer
 
-from squib import utility
+from squib import ringbuffer, scheduler, utility, wire
 
 ##############################################################################
 
 def create_oxidizer (name, config, metrics_recorder):
     if config.has_key("class"):
+        try:
+            inprocess = convert_to_bool(config.get('inprocess', False))
+        except ConversionError:
+            raise ConfigError("%s::inprocess must be a boolean" % name)
+        if inprocess:
+            return InProcessOxidizer(name, config, metrics_recorder)
+        if config.get('group'):
+            return GroupedOxidizer(name, config, metrics_recorder)
         return PythonOxidizer(name, config, metrics_recorder)
     else:
         raise ConfigError("Unknown type of oxidizer: %s" % name)
 
+def get_metrics_ttl (name, config):
+    ttl = config.get('ttl')
+    if ttl is None:
+        return None
+    try:
+        return convert_to_seconds(ttl) or None
+    except ConversionError:
+        raise ConfigError('%s::ttl must be a time period' % name)
+
 ##############################################################################
 
 class BaseOxidizer (ChildController):
@@ -40,13 +58,25 @@ class BaseOxidizer (ChildController):
         super(BaseOxidizer, self).__init__(name)
         self.config = config
         self.metrics_recorder = metrics_recorder
+        self.setup_metrics_reader()
         self.setup()
 
     def setup (self):
         pass
 
+    def setup_metrics_reader (self):
+        self.ttl = get_metrics_ttl(self.name, self.config)
+        max_line_length = self.config.get('max_line_length')
+        if max_line_length is None:
+            self.max_line_length = MetricsReader.default_max_line_length
+        else:
+            try:
+                self.max_line_length = convert_to_integer(max_line_length)
+            except ConversionError:
+                raise ConfigError('%s::max_line_length must be an integer number' % self.name)
+
     def get_stdout_reactable (self, stdout_fd):
-        return MetricsReader(self.metrics_recorder, fd=stdout_fd)
+        return MetricsReader(self.metrics_recorder, max_line_length=self.max_line_length, ttl=self.ttl, fd=stdout_fd)
 
     def get_stderr_reactable (self, stderr_fd):
         return ErrorReporter(fd=stderr_fd)
@@ -55,7 +85,10 @@ class BaseOxidizer (ChildController):
 
 class PythonOxidizer (BaseOxidizer):
 
+    default_ring_size = 1048576 # bytes
+
     def setup (self):
+        self.log = getlog()
 
         class OxidizerCallableWrapper (object):
             def __init__ (inself, call, conf):
@@ -95,6 +128,42 @@ class PythonOxidizer (BaseOxidizer):
             # Give up
             raise ConfigError("Cannot determine how to invoke this oxidizer: %s" % klass)
 
+        self.setup_transport()
+
+    def setup_transport (self):
+        self.ring = None
+        transport = self.config.get('transport', 'pipe').strip().lower()
+        if transport == 'pipe':
+            return
+        if transport != 'ring':
+            raise ConfigError('%s::transport must be one of: pipe,ring' % self.name)
+
+        ring_size = self.config.get('ring_size')
+        if ring_size is None:
+            ring_size = self.default_ring_size
+        else:
+            try:
+                ring_size = convert_to_integer(ring_size)
+            except ConversionError:
+                raise ConfigError('%s::ring_size must be an integer number' % self.name)
+
+        if not isinstance(self.oxidizer, BasePythonOxidizer):
+            self.log.warning('%s: only python oxidizer classes can use a ring transport. Using a pipe' % self.name)
+            return
+        try:
+            self.ring = ringbuffer.RingBuffer(ring_size)
+        except ringbuffer.RingBufferError, why:
+            self.log.warning('%s: cannot create a ring transport (%s). Using a pipe' % (self.name, why))
+            return
+        self.oxidizer.set_emitter(ringbuffer.RingEmitter(self.ring))
+
+    def get_stdout_reactable (self, stdout_fd):
+        if self.ring is not None:
+            return RingMetricsReader(self.metrics_recorder, self.ring, ttl=self.ttl, fd=stdout_fd)
+        if getattr(self.oxidizer, 'wire_protocol', 'text') == 'binary':
+            return BinaryMetricsReader(self.metrics_recorder, ttl=self.ttl, fd=stdout_fd)
+        return super(PythonOxidizer, self).get_stdout_reactable(stdout_fd)
+
     def rename_oxidizer_process (self):
         pname = 'ox:%s' % self.name
         utility.set_process_name(pname)
@@ -109,26 +178,245 @@ class PythonOxidizer (BaseOxidizer):
             
 ##############################################################################
 
+def find_periodic_oxidizer (config):
+    klass = config.get("class")
+    try:
+        obj = utility.find_python_object(klass)
+    except ImportError, err:
+        raise ConfigError("Cannot find the oxidizer object: %s" % klass)
+
+    if not (type(obj) is type and issubclass(obj, PeriodicOxidizer)):
+        raise ConfigError("Only PeriodicOxidizer classes can be scheduled by squib: %s" % klass)
+    return obj
+
+class GroupedOxidizer (object):
+    """
+    A PeriodicOxidizer that shares a child process (an OxidizerGroup) with
+    the other oxidizers of the same group.
+    """
+
+    def __init__ (self, name, config, metrics_recorder):
+        self.name = name
+        self.config = config
+        self.metrics_recorder = metrics_recorder
+        self.group = config.get('group').strip()
+        self.oxidizer = find_periodic_oxidizer(config)(name, config)
+        self.ttl = get_metrics_ttl(name, config)
+
+        jitter = config.get('jitter')
+        if jitter is None:
+            self.jitter = 0.0
+        else:
+            try:
+                self.jitter = convert_to_seconds(jitter)
+            except ConversionError:
+                raise ConfigError('%s::jitter must be a time period' % name)
+
+class OxidizerGroup (BaseOxidizer):
+
+    def setup (self):
+        self.members = []
+
+    def add_member (self, member):
+        self.members.append(member)
+        # One reader serves every member, so it gets the longest ttl
+        ttls = [ m.ttl for m in self.members ]
+        if None in ttls:
+            self.ttl = None
+        else:
+            self.ttl = max(ttls)
+
+    def rename_oxidizer_process (self):
+        pname = 'ox:%s' % self.name
+        utility.set_process_name(pname)
+
+    def get_stdout_reactable (self, stdout_fd):
+        if self.wire_protocol() == 'binary':
+            return BinaryMetricsReader(self.metrics_recorder, ttl=self.ttl, fd=stdout_fd)
+        return super(OxidizerGroup, self).get_stdout_reactable(stdout_fd)
+
+    def wire_protocol (self):
+        # One stream carries every member's metrics, so they must share
+        # one emitter. Binary only if every member asked for it.
+        for member in self.members:
+            if member.oxidizer.wire_protocol != 'binary':
+                return 'text'
+        return 'binary'
+
+    def run (self):
+        self.rename_oxidizer_process()
+        emitter = wire.create_emitter(self.wire_protocol())
+        oxscheduler = scheduler.OxidizerScheduler(emitter)
+        for member in self.members:
+            member.oxidizer.set_emitter(emitter)
+            oxscheduler.add(member.oxidizer, member.jitter)
+        try:
+            oxscheduler.run()
+        except:
+            tb = traceback.format_exc()
+            os.write(2, '\'%s\' oxidizer group threw an unexpected exception:\n%s' % (self.name, tb))
+
+##############################################################################
+
+class InProcessOxidizer (object):
+    """
+    Runs a PeriodicOxidizer on the parent's reactor instead of in a child
+    process. Meant for cheap collectors (a /proc read or two); anything
+    that can block belongs in a child.
+    """
+
+    def __init__ (self, name, config, metrics_recorder):
+        self.name = name
+        self.config = config
+        self.metrics_recorder = metrics_recorder
+        self.log = getlog()
+        self.setup()
+
+    def setup (self):
+        self.oxidizer = find_periodic_oxidizer(self.config)(self.name, self.config)
+        ttl = get_metrics_ttl(self.name, self.config)
+        self.oxidizer.set_emitter(RecorderEmitter(self.metrics_recorder, ttl))
+
+    def start (self):
+        self.next_run = time.time() + self.oxidizer.period
+        get_reactor().call_later(self.oxidizer.period, self.run_once)
+
+    def run_once (self):
+        try:
+            try:
+                self.oxidizer.run_once()
+            except:
+                self.log.error('\'%s\' oxidizer threw an unexpected exception:\n%s' % (self.name, traceback.format_exc()))
+        finally:
+            now = time.time()
+            self.next_run += self.oxidizer.period
+            if self.next_run < now:
+                self.next_run = now + self.oxidizer.period
+            get_reactor().call_later(self.next_run - now, self.run_once)
+
+class RecorderEmitter (object):
+    """
+    An emitter for in-process oxidizers, recording straight into the
+    MetricsRecorder.
+    """
+
+    def __init__ (self, metrics_recorder, ttl=None):
+        self.metrics_recorder = metrics_recorder
+        self.ttl = ttl
+        self.metrics = {}
+        self.generation = metrics_recorder.generation
+        self.recorded = 0
+
+    def emit (self, name, value, mtype=None):
+        if self.generation != self.metrics_recorder.generation:
+            # Metrics were evicted. Look them all up again as needed
+            self.metrics = {}
+            self.generation = self.metrics_recorder.generation
+        m = self.metrics.get((name, mtype))
+        if m is None:
+            m = self.metrics_recorder.lookup_metric(name, mtype or 'gauge', self.ttl)
+            if self.generation != self.metrics_recorder.generation:
+                # The lookup evicted metrics, possibly some of ours
+                self.metrics = {}
+                self.generation = self.metrics_recorder.generation
+            self.metrics[(name, mtype)] = m
+        if value.__class__ is str:
+            m.update(value)
+        else:
+            m.update_number(value)
+        m.last_update = time.time()
+        self.recorded += 1
+
+    def flush (self):
+        if self.recorded:
+            self.metrics_recorder.mark_recorded(self.recorded)
+            self.recorded = 0
+
+##############################################################################
+
 class MetricsReader (ReadOnlyFileDescriptorReactable):
 
-    def __init__ (self, metrics_recorder, **kw):
+    default_max_line_length = 8192 # bytes
+
+    def __init__ (self, metrics_recorder, max_line_length=None, ttl=None, **kw):
         super(MetricsReader, self).__init__(**kw)
         self.metrics_recorder = metrics_recorder
-        self.buff = ''
+        self.ttl = ttl
+        if max_line_length is None:
+            max_line_length = self.default_max_line_length
+        self.max_line_length = max_line_length
+        self.buff = bytearray()
+        self.overlong = False
         self.log = getlog()
 
     def on_data_read (self, data):
-        self.buff += data
-        lines, _unused, self.buff = self.buff.rpartition('\n')
+        # Only the unterminated tail of a read is ever buffered, so the
+        # buffer never grows beyond max_line_length and complete lines are
+        # never copied more than once. The tail is buffered whatever becomes
+        # of the complete lines, so the next read starts where this one ended.
+        lines = data.split('\n')
+        partial = lines.pop()
         if lines:
-            for line in lines.split('\n'):
-                if not line: continue
-                try:
-                    mname, mvalue = line.split(' ', 1)
-                except ValueError:
-                    self.log.warning('Invalid metric: %s' % line)
-                    continue
-                self.metrics_recorder.record(mname, mvalue)
+            if self.buff or self.overlong:
+                lines[0] = self.complete_line(lines[0])
+            if len(data) > self.max_line_length and max(map(len, lines)) > self.max_line_length:
+                self.log.warning('Discarding a metric line longer than %d bytes' % self.max_line_length)
+                lines = [ l for l in lines if len(l) <= self.max_line_length ]
+        try:
+            if lines:
+                self.metrics_recorder.record_many(lines, self.ttl)
+        finally:
+            if partial:
+                self.buffer_partial(partial)
+
+    def buffer_partial (self, data):
+        if self.overlong: return
+        if len(self.buff) + len(data) > self.max_line_length:
+            self.discard_line()
+            return
+        self.buff += data
+
+    def complete_line (self, data):
+        if self.overlong:
+            self.overlong = False
+            return ''
+        if len(self.buff) + len(data) > self.max_line_length:
+            self.discard_line()
+            self.overlong = False
+            return ''
+        self.buff += data
+        line = str(self.buff)
+        del self.buff[:]
+        return line
+
+    def discard_line (self):
+        self.log.warning('Discarding a metric line longer than %d bytes' % self.max_line_length)
+        del self.buff[:]
+        self.overlong = True
+
+class BinaryMetricsReader (ReadOnlyFileDescriptorReactable):
+
+    def __init__ (self, metrics_recorder, ttl=None, **kw):
+        super(BinaryMetricsReader, self).__init__(**kw)
+        self.decoder = wire.FrameDecoder(metrics_recorder, ttl)
+
+    def on_data_read (self, data):
+        self.decoder.feed(data)
+
+class RingMetricsReader (ReadOnlyFileDescriptorReactable):
+    """
+    Drains an oxidizer's ring buffer. Only doorbells arrive on the pipe.
+    """
+
+    def __init__ (self, metrics_recorder, ring, ttl=None, **kw):
+        super(RingMetricsReader, self).__init__(**kw)
+        self.ring = ring
+        self.decoder = wire.FrameDecoder(metrics_recorder, ttl)
+
+    def on_data_read (self, data):
+        data = self.ring.read()
+        if data:
+            self.decoder.feed(data)
 
 class ErrorReporter (ReadOnlyFileDescriptorReactable):
 
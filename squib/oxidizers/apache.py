@@ -78,27 +78,28 @@ class ApacheOxidizer (PeriodicOxidizer):
             if not line: continue
             key, value = [ l.strip() for l in line.split(':', 1) ]
             if key == 'Total Accesses':
-                print '%s.requests derivmeter %s' % (self.name, value)
+                self.emit('%s.requests' % self.name, value, 'derivmeter')
             elif key == 'Total kBytes':
-                print '%s.kbytes derivmeter %s' % (self.name, value)
+                self.emit('%s.kbytes' % self.name, value, 'derivmeter')
             elif key == 'BusyWorkers':
-                print '%s.busyworkers gauge %s' % (self.name, value)
+                self.emit('%s.busyworkers' % self.name, value, 'gauge')
             elif key == 'IdleWorkers':
-                print '%s.idleworkers gauge %s' % (self.name, value)
+                self.emit('%s.idleworkers' % self.name, value, 'gauge')
             elif key == 'Scoreboard':
                 for j in range(len(value)):
                     scoreboard[value[j]] += 1
-                print '%s.scoreboard.waiting gauge %s'     % (self.name, scoreboard['_'])
-                print '%s.scoreboard.starting gauge %s'    % (self.name, scoreboard['S'])
-                print '%s.scoreboard.reading gauge %s'     % (self.name, scoreboard['R'])
-                print '%s.scoreboard.writing gauge %s'     % (self.name, scoreboard['W'])
-                print '%s.scoreboard.keepalive gauge %s'   % (self.name, scoreboard['K'])
-                print '%s.scoreboard.dnslookup gauge %s'   % (self.name, scoreboard['D'])
-                print '%s.scoreboard.closing gauge %s'     % (self.name, scoreboard['C'])
-                print '%s.scoreboard.logging gauge %s'     % (self.name, scoreboard['L'])
-                print '%s.scoreboard.finishing gauge %s'   % (self.name, scoreboard['G'])
-                print '%s.scoreboard.idlecleanup gauge %s' % (self.name, scoreboard['I'])
-                print '%s.scoreboard.openslot gauge %s'    % (self.name, scoreboard['.'])
+                self.emit('%s.scoreboard.waiting' % self.name, scoreboard['_'], 'gauge')
+                self.emit('%s.scoreboard.starting' % self.name, scoreboard['S'], 'gauge')
+                self.emit('%s.scoreboard.reading' % self.name, scoreboard['R'], 'gauge')
+                self.emit('%s.scoreboard.writing' % self.name, scoreboard['W'], 'gauge')
+                self.emit('%s.scoreboard.keepalive' % self.name, scoreboard['K'], 'gauge')
+                self.emit('%s.scoreboard.dnslookup' % self.name, scoreboard['D'], 'gauge')
+                self.emit('%s.scoreboard.closing' % self.name, scoreboard['C'], 'gauge')
+                self.emit('%s.scoreboard.logging' % self.name, scoreboard['L'], 'gauge')
+                self.emit('%s.scoreboard.finishing' % self.name, scoreboard['G'], 'gauge')
+                self.emit('%s.scoreboard.idlecleanup' % self.name, scoreboard['I'], 'gauge')
+                self.emit('%s.scoreboard.openslot' % self.name, scoreboard['.'], 'gauge')
+        self.flush()
 
 
     def read_raw_status (self):
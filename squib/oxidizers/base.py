@@ -16,21 +16,45 @@
 
 import time
 
+from mccorelib.config            import ConfigError
 from mccorelib.string_conversion import convert_to_seconds, ConversionError
+from squib                       import wire
 
 ##############################################################################
 
 class BasePythonOxidizer (object):
 
+    default_wire_protocol = 'text'
+
     def __init__ (self, name, config):
         super(BasePythonOxidizer, self).__init__()
         self.name = name
         self.config = config
+        self.setup_wire_protocol()
         self.setup()
 
     def setup (self):
         pass
 
+    def setup_wire_protocol (self):
+        protocol = self.config.get('wire_protocol')
+        if protocol is None:
+            self.wire_protocol = self.default_wire_protocol
+        else:
+            self.wire_protocol = protocol.strip().lower()
+            if self.wire_protocol not in wire.WIRE_PROTOCOLS:
+                raise ConfigError('%s::wire_protocol must be one of: %s' % (self.name, ','.join(wire.WIRE_PROTOCOLS)))
+        self.emitter = wire.create_emitter(self.wire_protocol)
+
+    def set_emitter (self, emitter):
+        self.emitter = emitter
+
+    def emit (self, name, value, mtype=None):
+        self.emitter.emit(name, value, mtype)
+
+    def flush (self):
+        self.emitter.flush()
+
     def run (self):
         pass
 
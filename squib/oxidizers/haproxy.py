@@ -52,7 +52,8 @@ class HaproxyOxidizer (PeriodicOxidizer):
                         mtype = 'string'
                     else:
                         mtype = 'gauge'
-                    print '%s.%s.%s.%s %s %s' % (self.name, parts[0], parts[1], m, mtype, val)
+                    self.emit('%s.%s.%s.%s' % (self.name, parts[0], parts[1], m), val, mtype)
+        self.flush()
 
     def read_stats_socket (self):
         sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
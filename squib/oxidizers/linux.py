@@ -14,7 +14,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import os, re, sys, time
+import os, re, time
 
 from mccorelib.config            import ConfigError
 from mccorelib.string_conversion import convert_to_bool, ConversionError
@@ -33,14 +33,14 @@ class CpuOxidizer (PeriodicOxidizer):
         raw = self.raw_cpu()
         diff = [ float(raw[x] - self.prev_cpu_stats[x]) for x in range(7) ]
         total = float(reduce(lambda x,y: x+y, diff))
-        print 'cpu.user %.2f' % (diff[0] / total * 100)
-        print 'cpu.nice %.2f' % (diff[1] / total * 100)
-        print 'cpu.system %.2f' % (diff[2] / total * 100)
-        print 'cpu.idle %.2f' % (diff[3] / total * 100)
-        print 'cpu.iowait %.2f' % (diff[4] / total * 100)
-        print 'cpu.irq %.2f' % (diff[5] / total * 100)
-        print 'cpu.softirq %.2f' % (diff[6] / total * 100)
-        sys.stdout.flush()
+        self.emit('cpu.user',    '%.2f' % (diff[0] / total * 100))
+        self.emit('cpu.nice',    '%.2f' % (diff[1] / total * 100))
+        self.emit('cpu.system',  '%.2f' % (diff[2] / total * 100))
+        self.emit('cpu.idle',    '%.2f' % (diff[3] / total * 100))
+        self.emit('cpu.iowait',  '%.2f' % (diff[4] / total * 100))
+        self.emit('cpu.irq',     '%.2f' % (diff[5] / total * 100))
+        self.emit('cpu.softirq', '%.2f' % (diff[6] / total * 100))
+        self.flush()
         self.prev_cpu_stats = raw
 
     def raw_cpu (self):
@@ -58,10 +58,10 @@ class FileDescriptorOxidizer (PeriodicOxidizer):
         line = f.readline()
         f.close()
         fd = [ int(el) for el in line.split() ]
-        print 'filedescriptors.used %d' % (fd[0])
-        print 'filedescriptors.free %d' % (fd[1])
-        print 'filedescriptors.max %d' % (fd[2])
-        sys.stdout.flush()
+        self.emit('filedescriptors.used', fd[0])
+        self.emit('filedescriptors.free', fd[1])
+        self.emit('filedescriptors.max',  fd[2])
+        self.flush()
 
 ##############################################################################
 
@@ -80,15 +80,15 @@ class FileSystemOxidizer (PeriodicOxidizer):
             else:
                 fsname = filesystem.replace('/', '_')
             fs = os.statvfs(filesystem)
-            print 'filesystem.%s.size.total %d' % (fsname, fs.f_frsize * fs.f_blocks)
-            print 'filesystem.%s.size.used %d' % (fsname, (fs.f_frsize * fs.f_blocks) - (fs.f_frsize * fs.f_bfree))
-            print 'filesystem.%s.size.free %d'  % (fsname, fs.f_frsize * fs.f_bfree)
-            print 'filesystem.%s.size.avail %d' % (fsname, fs.f_frsize * fs.f_bavail)
-            print 'filesystem.%s.inodes.total %d' % (fsname, fs.f_files)
-            print 'filesystem.%s.inodes.used %d' % (fsname, fs.f_files - fs.f_ffree)
-            print 'filesystem.%s.inodes.free %d'  % (fsname, fs.f_ffree)
-            print 'filesystem.%s.inodes.avail %d' % (fsname, fs.f_favail)
-        sys.stdout.flush()
+            self.emit('filesystem.%s.size.total' % fsname,   fs.f_frsize * fs.f_blocks)
+            self.emit('filesystem.%s.size.used' % fsname,    (fs.f_frsize * fs.f_blocks) - (fs.f_frsize * fs.f_bfree))
+            self.emit('filesystem.%s.size.free' % fsname,    fs.f_frsize * fs.f_bfree)
+            self.emit('filesystem.%s.size.avail' % fsname,   fs.f_frsize * fs.f_bavail)
+            self.emit('filesystem.%s.inodes.total' % fsname, fs.f_files)
+            self.emit('filesystem.%s.inodes.used' % fsname,  fs.f_files - fs.f_ffree)
+            self.emit('filesystem.%s.inodes.free' % fsname,  fs.f_ffree)
+            self.emit('filesystem.%s.inodes.avail' % fsname, fs.f_favail)
+        self.flush()
 
     def find_local_filesystems (self):
         f = open('/proc/mounts', 'r')
@@ -110,9 +110,9 @@ class InodeOxidizer (PeriodicOxidizer):
         line = f.readline()
         f.close()
         inode = [ int(el) for el in line.split() ]
-        print 'inodes.used %d' % (inode[0])
-        print 'inodes.free %d' % (inode[1])
-        sys.stdout.flush()
+        self.emit('inodes.used', inode[0])
+        self.emit('inodes.free', inode[1])
+        self.flush()
 
 ##############################################################################
 
@@ -125,12 +125,12 @@ class MemOxidizer (PeriodicOxidizer):
         mem = []
         for x in range(4):
             mem.append(int(lines[x].split()[1], 10) * 1024)
-        print 'mem.total %d' % (mem[0])
-        print 'mem.free %d' % (mem[1])
-        print 'mem.buffers %d' % (mem[2])
-        print 'mem.cached %d' % (mem[3])
-        print 'mem.used %d' %(mem[0] - sum(mem[1:]))
-        sys.stdout.flush()
+        self.emit('mem.total',   mem[0])
+        self.emit('mem.free',    mem[1])
+        self.emit('mem.buffers', mem[2])
+        self.emit('mem.cached',  mem[3])
+        self.emit('mem.used',    mem[0] - sum(mem[1:]))
+        self.flush()
 
 ##############################################################################
 
@@ -243,20 +243,21 @@ class TrafficOxidizer (PeriodicOxidizer):
             if not self.should_track_interface(iface):
                 continue
 
-            runits = rbytes * self.units
-            tunits = tbytes * self.units
-
-            print '%s.%s.rtraffic derivgauge %d' % (self.name, iface, runits)
-            print '%s.%s.rtraffic derivmeter %d' % (self.name, iface, runits)
-            print '%s.%s.rpackets derivgauge %d' % (self.name, iface, rpackets)
-            print '%s.%s.rerrors derivgauge %d'  % (self.name, iface, rerrors)
-            print '%s.%s.rdrops derivgauge %d'   % (self.name, iface, rdrops)
-            print '%s.%s.ttraffic derivgauge %d' % (self.name, iface, tunits)
-            print '%s.%s.ttraffic derivmeter %d' % (self.name, iface, tunits)
-            print '%s.%s.tpackets derivgauge %d' % (self.name, iface, tpackets)
-            print '%s.%s.terrors derivgauge %d'  % (self.name, iface, terrors)
-            print '%s.%s.tdrops derivgauge %d'   % (self.name, iface, tdrops)
-            sys.stdout.flush()
+            runits = int(rbytes * self.units)
+            tunits = int(tbytes * self.units)
+
+            prefix = '%s.%s.' % (self.name, iface)
+            self.emit(prefix + 'rtraffic', runits,   'derivgauge')
+            self.emit(prefix + 'rtraffic', runits,   'derivmeter')
+            self.emit(prefix + 'rpackets', rpackets, 'derivgauge')
+            self.emit(prefix + 'rerrors',  rerrors,  'derivgauge')
+            self.emit(prefix + 'rdrops',   rdrops,   'derivgauge')
+            self.emit(prefix + 'ttraffic', tunits,   'derivgauge')
+            self.emit(prefix + 'ttraffic', tunits,   'derivmeter')
+            self.emit(prefix + 'tpackets', tpackets, 'derivgauge')
+            self.emit(prefix + 'terrors',  terrors,  'derivgauge')
+            self.emit(prefix + 'tdrops',   tdrops,   'derivgauge')
+            self.flush()
 
 ##############################################################################
 ## THE END
@@ -43,28 +43,28 @@ class PGBouncerOxidizer (PeriodicOxidizer):
         for row in [ dict(r) for r in cursor ]:
             if row['database'] == 'pgbouncer': continue
             prefix = '%s.%s.%s.' % (self.name, row['database'], row['user'])
-            print prefix + 'cl_active gauge %d' % row['cl_active']
-            print prefix + 'cl_waiting gauge %d' % row['cl_waiting']
-            print prefix + 'sv_active gauge %d' % row['sv_active']
-            print prefix + 'sv_idle gauge %d' % row['sv_idle']
-            print prefix + 'sv_used gauge %d' % row['sv_used']
-            print prefix + 'sv_tested gauge %d' % row['sv_tested']
-            print prefix + 'sv_login gauge %d' % row['sv_login']
-            print prefix + 'maxwait_us hist %d' % row['maxwait_us']
+            self.emit(prefix + 'cl_active', row['cl_active'], 'gauge')
+            self.emit(prefix + 'cl_waiting', row['cl_waiting'], 'gauge')
+            self.emit(prefix + 'sv_active', row['sv_active'], 'gauge')
+            self.emit(prefix + 'sv_idle', row['sv_idle'], 'gauge')
+            self.emit(prefix + 'sv_used', row['sv_used'], 'gauge')
+            self.emit(prefix + 'sv_tested', row['sv_tested'], 'gauge')
+            self.emit(prefix + 'sv_login', row['sv_login'], 'gauge')
+            self.emit(prefix + 'maxwait_us', row['maxwait_us'], 'hist')
 
         cursor.execute('SHOW STATS_TOTALS')
         for row in [ dict(r) for r in cursor ]:
             if row['database'] == 'pgbouncer': continue
             prefix = '%s.%s.' % (self.name, row['database'])
-            print prefix + 'xact_count derivmeter %d' % row['xact_count']
-            print prefix + 'query_count derivmeter %d' % row['query_count']
-            print prefix + 'bytes_received derivmeter %d' % row['bytes_received']
-            print prefix + 'bytes_sent derivmeter %d' % row['bytes_sent']
-            print prefix + 'xact_time derivmeter %d' % row['xact_time']
-            print prefix + 'query_time derivmeter %d' % row['query_time']
-            print prefix + 'wait_time derivmeter %d' % row['wait_time']
+            self.emit(prefix + 'xact_count', row['xact_count'], 'derivmeter')
+            self.emit(prefix + 'query_count', row['query_count'], 'derivmeter')
+            self.emit(prefix + 'bytes_received', row['bytes_received'], 'derivmeter')
+            self.emit(prefix + 'bytes_sent', row['bytes_sent'], 'derivmeter')
+            self.emit(prefix + 'xact_time', row['xact_time'], 'derivmeter')
+            self.emit(prefix + 'query_time', row['query_time'], 'derivmeter')
+            self.emit(prefix + 'wait_time', row['wait_time'], 'derivmeter')
 
-	sys.stdout.flush()
+        self.flush()
 
     def get_cursor (self):
         if self.conn is not None: return self.conn.cursor()
@@ -14,7 +14,6 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import sys
 import socket_metrics
 
 from squib.oxidizers.base         import PeriodicOxidizer
@@ -30,18 +29,18 @@ class TcpSocketsOxidizer (PeriodicOxidizer):
             # Failed to retrieve the stats. Damn.
             return
 
-        print 'tcpsockets.established %d' % states[0]
-        print 'tcpsockets.syn_sent %d'    % states[1]
-        print 'tcpsockets.syn_recv %d'    % states[2]
-        print 'tcpsockets.fin_wait1 %d'   % states[3]
-        print 'tcpsockets.fin_wait2 %d'   % states[4]
-        print 'tcpsockets.time_wait %d'   % states[5]
-        print 'tcpsockets.close %d'       % states[6]
-        print 'tcpsockets.close_wait %d'  % states[7]
-        print 'tcpsockets.last_ack %d'    % states[8]
-        print 'tcpsockets.listen %d'      % states[9]
-        print 'tcpsockets.closed %d'      % states[10]
-        sys.stdout.flush()
+        self.emit('tcpsockets.established', states[0])
+        self.emit('tcpsockets.syn_sent',    states[1])
+        self.emit('tcpsockets.syn_recv',    states[2])
+        self.emit('tcpsockets.fin_wait1',   states[3])
+        self.emit('tcpsockets.fin_wait2',   states[4])
+        self.emit('tcpsockets.time_wait',   states[5])
+        self.emit('tcpsockets.close',       states[6])
+        self.emit('tcpsockets.close_wait',  states[7])
+        self.emit('tcpsockets.last_ack',    states[8])
+        self.emit('tcpsockets.listen',      states[9])
+        self.emit('tcpsockets.closed',      states[10])
+        self.flush()
 
 ##############################################################################
 
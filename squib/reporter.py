@@ -14,9 +14,10 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import socket
+import collections, cPickle, errno, os, random, socket, struct, sys, time
 
-from mccorelib.asyncnet          import TCPReactable, MulticastReactable
+from mccorelib.async             import get_reactor
+from mccorelib.asyncnet          import TCPReactable
 from mccorelib.asyncsvr          import TCPServer
 from mccorelib.http              import HTTPProtocol
 from mccorelib.baseobject        import BaseObject
@@ -24,22 +25,108 @@ from mccorelib.config            import ConfigError
 from mccorelib.log               import getlog
 from mccorelib.string_conversion import convert_to_bool, convert_to_integer, convert_to_seconds, ConversionError
 
+from squib.spool import Spool, SpoolError
+
+##############################################################################
+
+class ReportSnapshot (object):
+    """
+    One publish of the metrics recorder, shared by the reporters sending it.
+    The metrics of the report are selected once, on first use, and their
+    values taken, so that a snapshot waiting in a queue is not changed by
+    the next publish. Every form of the report is made from those values.
+    """
+
+    def __init__ (self, metrics_recorder, changes_only=False, heartbeat=None):
+        self.metrics_recorder = metrics_recorder
+        self.changes_only = changes_only
+        self.heartbeat = heartbeat
+        self.created = time.time()
+        self.metrics = None
+        self.values = None
+        self.epoch = None
+        self.forms = {}
+
+    def publish (self):
+        if self.metrics is None:
+            self.metrics, self.epoch = self.metrics_recorder.publish_metrics(self.changes_only, self.heartbeat)
+            self.values = [ m.values for m in self.metrics ]
+        return self.metrics
+
+    def text (self, numeric_only=False):
+        key = ('text', numeric_only)
+        text = self.forms.get(key)
+        if text is None:
+            metrics = self.publish()
+            text = self.metrics_recorder.metrics_text(metrics, self.epoch, numeric_only, self.values)
+            self.forms[key] = text
+        return text
+
+    def lines (self, numeric_only=False):
+        key = ('lines', numeric_only)
+        lines = self.forms.get(key)
+        if lines is None:
+            lines = self.forms[key] = self.text(numeric_only).splitlines()
+        return lines
+
+    def full_lines (self, numeric_only=False):
+        # Every metric's lines, even when this publish left out the ones
+        # that did not change
+        if not self.changes_only:
+            return self.lines(numeric_only)
+        key = ('full', numeric_only)
+        lines = self.forms.get(key)
+        if lines is None:
+            self.publish()
+            text = self.metrics_recorder.republish_text(self.epoch, numeric_only)
+            lines = self.forms[key] = text.splitlines()
+        return lines
+
+    def datapoints (self):
+        datapoints = self.forms.get('datapoints')
+        if datapoints is None:
+            metrics = self.publish()
+            datapoints = self.metrics_recorder.metrics_datapoints(metrics, self.epoch, self.values)
+            self.forms['datapoints'] = datapoints
+        return datapoints
+
+    def pickles (self, batch_size):
+        # Length prefixed pickles of the datapoints, for carbon
+        key = ('pickles', batch_size)
+        pickles = self.forms.get(key)
+        if pickles is None:
+            pickles = self.forms[key] = pickle_datapoints(self.datapoints(), batch_size)
+        return pickles
+
 ##############################################################################
 
 class BaseReporter (BaseObject):
 
     default_report_period = 10.0 # seconds
+    default_heartbeat     = 30   # reports
+
+    # Leave string metrics out of the reports
+    numeric_only = False
+
+    # True if the reporter records the latency of its reports itself, when
+    # they are sent
+    records_latency = False
 
-    def __init__ (self, reporter_config, metrics_recorder, **kw):
+    def __init__ (self, reporter_config, metrics_recorder, name=None, **kw):
         super(BaseReporter, self).__init__(**kw)
         #self._parse_options(BaseReporter.options, kw)
         self.reporter_config = reporter_config
         self.metrics_recorder = metrics_recorder
+        # The reporter has no name, and its own section, unless it is a
+        # child of a composite reporter
+        self.name = name
+        self.section = name or 'reporter'
         self.log = getlog()
         self.setup()
 
     def setup (self):
         self.setup_report_period()
+        self.setup_changes_only()
 
     def setup_report_period (self):
         if self.reporter_config is None:
@@ -54,42 +141,267 @@ class BaseReporter (BaseObject):
         try:
             self.report_period = convert_to_seconds(report_period)
         except ConversionError:
-            raise ConfigError('reporter::period must be a floating point number')
+            raise ConfigError('%s::period must be a floating point number' % self.section)
+
+    def setup_changes_only (self):
+        # With changes_only, reports hold only the metrics that changed since
+        # the previous report, plus a full report every heartbeat reports.
+        self.changes_only = False
+        self.heartbeat = BaseReporter.default_heartbeat
+        if self.reporter_config is None:
+            return
+
+        try:
+            self.changes_only = convert_to_bool(self.reporter_config.get('changes_only', False))
+        except ConversionError:
+            raise ConfigError('%s::changes_only must be a boolean' % self.section)
+
+        heartbeat = self.reporter_config.get('heartbeat')
+        if heartbeat is not None:
+            try:
+                self.heartbeat = convert_to_integer(heartbeat)
+            except ConversionError:
+                raise ConfigError('%s::heartbeat must be an integer number' % self.section)
+            if self.heartbeat < 0:
+                raise ConfigError('%s::heartbeat must not be negative' % self.section)
+
+        if self.changes_only:
+            if self.heartbeat:
+                self.log.info('Reporting changed metrics only, with a full report every %d reports' % self.heartbeat)
+            else:
+                self.log.info('Reporting changed metrics only, with no full reports')
 
     def get_report_period (self):
         return self.report_period
 
     def send_report (self):
-        pass
+        self.deliver(ReportSnapshot(self.metrics_recorder, self.changes_only, self.heartbeat))
+
+    def deliver (self, snapshot):
+        # Sends one report, taken from a ReportSnapshot. Reporters written
+        # before snapshots only have a send_report(), that publishes for
+        # itself.
+        if self.__class__.send_report.im_func is not BaseReporter.send_report.im_func:
+            self.send_report()
 
 ##############################################################################
 
 class NopReporter (BaseReporter):
 
-    def send_report (self):
+    def deliver (self, snapshot):
         # Execute the metrics_recorder's publish function, 
         #but do nothing with the results
-        self.metrics_recorder.publish()
+        snapshot.text()
 
 ##############################################################################
 
 class SimpleLogReporter (BaseReporter):
 
-    def send_report (self):
-        lines = self.metrics_recorder.publish()
+    def deliver (self, snapshot):
+        lines = snapshot.lines()
         for line in lines:
             self.log.info("REPORT: %s" % line)
 
 ##############################################################################
 
+class FileReporter (BaseReporter):
+    """
+    Keeps the latest report in a local file. The file is replaced whole,
+    through a temporary file and a rename, so readers never see part of a
+    report. With append, every report is added to the end instead.
+    """
+
+    def setup (self):
+        super(FileReporter, self).setup()
+        self.path = self.reporter_config.get('path')
+        if not self.path:
+            raise ConfigError('%s::path must be specified' % self.section)
+        try:
+            self.append = convert_to_bool(self.reporter_config.get('append', False))
+        except ConversionError:
+            raise ConfigError('%s::append must be a boolean' % self.section)
+        self.log.info('Reporting to file: %s' % self.path)
+
+    def deliver (self, snapshot):
+        message = snapshot.text(self.numeric_only)
+        try:
+            if self.append:
+                fp = open(self.path, 'a')
+                try:
+                    fp.write(message)
+                finally:
+                    fp.close()
+            else:
+                temp_path = self.path + '.tmp'
+                fp = open(temp_path, 'w')
+                try:
+                    fp.write(message)
+                finally:
+                    fp.close()
+                os.rename(temp_path, self.path)
+        except (IOError, OSError), why:
+            self.log.warn('Failed to write report to %s: %s' % (self.path, str(why)))
+
+##############################################################################
+
+class ReporterQueue (object):
+    """
+    The snapshots waiting to be delivered to one child of a CompositeReporter.
+    """
+
+    def __init__ (self, name, reporter):
+        self.name = name
+        self.reporter = reporter
+        self.snapshots = collections.deque()
+        self.drain_at = None
+
+class CompositeReporter (BaseReporter):
+    """
+    Fans every report out to several reporters, named in the reporters
+    option and each configured in its own section. The metrics are published
+    once per period, and the snapshot is shared by all of them. The
+    period, changes_only and heartbeat of this reporter apply to all, and
+    cannot be set for the others.
+
+    Every child has its own queue of at most max_queue snapshots, drained
+    in reactor calls of its own, so a child that fails or falls behind
+    does not hold up the others. Its oldest snapshots are dropped when it
+    falls too far behind. Every child keeps its selfstats, the latency of
+    its reports among them, under squib.reporter.<name>.
+    """
+
+    default_max_queue = 3 # snapshots
+
+    def __init__ (self, reporter_config, metrics_recorder, children=(), **kw):
+        self.queues = [ ReporterQueue(name, reporter) for name, reporter in children ]
+        super(CompositeReporter, self).__init__(reporter_config, metrics_recorder, **kw)
+
+    def setup (self):
+        super(CompositeReporter, self).setup()
+        if not self.queues:
+            raise ConfigError('%s::reporters must name at least one reporter' % self.section)
+
+        max_queue = self.reporter_config.get('max_queue')
+        if max_queue is None:
+            self.max_queue = self.default_max_queue
+        else:
+            try:
+                self.max_queue = convert_to_integer(max_queue)
+            except ConversionError:
+                raise ConfigError('%s::max_queue must be an integer number' % self.section)
+            if self.max_queue < 1:
+                raise ConfigError('%s::max_queue must be at least 1' % self.section)
+        self.log.info('Reporting to: %s' % ', '.join([ queue.name for queue in self.queues ]))
+
+    def deliver (self, snapshot):
+        # Published now, so that every child gets the same report
+        snapshot.publish()
+        selfstats = self.metrics_recorder.selfstats
+        for queue in self.queues:
+            if len(queue.snapshots) >= self.max_queue:
+                queue.snapshots.popleft()
+                self.log.warn('Reporter %s is falling behind. Dropped its oldest report' % queue.name)
+                if selfstats is not None:
+                    selfstats.mark_reporter_dropped(name=queue.name)
+            queue.snapshots.append(snapshot)
+            self.schedule_drain(queue)
+
+    def schedule_drain (self, queue):
+        # A drain that was due longer than a report period ago was lost,
+        # with the reactor it was scheduled on
+        now = time.time()
+        if queue.drain_at is not None and now - queue.drain_at < self.report_period:
+            return
+        queue.drain_at = now
+        get_reactor().call_later(0, self.drain, queue)
+
+    def drain (self, queue):
+        queue.drain_at = None
+        if not queue.snapshots:
+            return
+        snapshot = queue.snapshots.popleft()
+        child = queue.reporter
+        try:
+            child.deliver(snapshot)
+        except Exception, why:
+            self.log.error('Reporter %s failed to send a report: %s' % (queue.name, str(why)))
+        else:
+            # Reporters that send over the network record their latency
+            # once the report is sent. For the others, it is done now.
+            selfstats = self.metrics_recorder.selfstats
+            if selfstats is not None and not getattr(child, 'records_latency', False):
+                selfstats.mark_reporter_latency(time.time() - snapshot.created, name=queue.name)
+        if queue.snapshots:
+            self.schedule_drain(queue)
+
+##############################################################################
+
+def resolve_address (host, port, socktype):
+    # (family, socket address) of the first address found. This blocks, so
+    # reporters only do it at setup.
+    family, _s, _p, _c, address = socket.getaddrinfo(host, port, 0, socktype)[0]
+    return family, address
+
+class ReporterConnection (TCPReactable):
+    """
+    The connection of a TcpReporter. The reactor tells it when the socket
+    can take more data, and the reporter does the writing.
+    """
+
+    def __init__ (self, reporter, **kw):
+        super(ReporterConnection, self).__init__(**kw)
+        self.reporter = reporter
+
+    def writable (self):
+        return not self.reporter.connected or len(self.reporter.pending) > 0
+
+    def handle_connect (self):
+        self.reporter.connection_made()
+
+    def handle_write (self):
+        self.reporter.write_pending()
+
+    def on_data_read (self, data):
+        # Nothing is expected back
+        pass
+
+    def handle_close (self):
+        self.reporter.connection_failed('connection closed by peer')
+
+    def handle_error (self):
+        self.reporter.connection_failed(sys.exc_info()[1])
+
 class TcpReporter (BaseReporter):
+    """
+    Sends reports over one long lived, non-blocking connection. Reports are
+    queued and written as the reactor finds the socket writable. A lost
+    connection is retried with exponential backoff and jitter, and a
+    connection that makes no progress for send_timeout is dropped.
+
+    With a spool_dir, reports that cannot be sent are kept in an on-disk
+    spool instead. Once the destination is back, new reports go out as
+    they come, and the spool is replayed, oldest first, in the gaps between
+    them at no more than spool_replay_rate bytes a second.
+    """
 
     default_destination_addr = None
     default_destination_port = None
 
+    default_send_timeout        = 5.0             # seconds
+    default_max_pending         = 4 * 1024 * 1024 # bytes
+    default_reconnect_delay     = 1.0             # seconds
+    default_max_reconnect_delay = 60.0            # seconds
+    default_spool_max_size      = 64 * 1024 * 1024 # bytes
+    default_spool_max_age       = 6 * 60 * 60     # seconds
+    default_spool_replay_rate   = 128 * 1024      # bytes/second
+
+    records_latency = True
+
     def setup (self):
         super(TcpReporter, self).setup()
         self.setup_address()
+        self.setup_connection()
+        self.setup_spool()
 
     def setup_address (self):
         destination_addr = self.reporter_config.get('destination_addr')
@@ -99,7 +411,7 @@ class TcpReporter (BaseReporter):
                                  % self.default_destination_addr)
                 self.destination_addr = self.default_destination_addr
             else:
-                raise ConfigError('reporter::destination_addr must be specified')
+                raise ConfigError('%s::destination_addr must be specified' % self.section)
         else:
             self.destination_addr = destination_addr
 
@@ -110,33 +422,365 @@ class TcpReporter (BaseReporter):
                                  % self.default_destination_port)
                 self.destination_port = self.default_destination_port
             else:
-                raise ConfigError('reporter::destination_port must be specified')
+                raise ConfigError('%s::destination_port must be specified' % self.section)
         else:
             try:
                 self.destination_port = convert_to_integer(destination_port)
             except ConversionError:
-                raise ConfigError('reporter::destination_port must be an integer number')
+                raise ConfigError('%s::destination_port must be an integer number' % self.section)
 
         self.log.info('Reporting to tcp address: %s:%s' % (self.destination_addr,
                                                            self.destination_port))
 
-    def send_report (self):
-        lines = self.metrics_recorder.publish()
-        message = '\n'.join(lines) + '\n'
-        self._send_tcp(message)
+    def setup_connection (self):
+        self.send_timeout = self.get_seconds_option('send_timeout', self.default_send_timeout)
+        self.reconnect_delay = self.get_seconds_option('reconnect_delay', self.default_reconnect_delay)
+        self.max_reconnect_delay = self.get_seconds_option('max_reconnect_delay', self.default_max_reconnect_delay)
+        if self.max_reconnect_delay < self.reconnect_delay:
+            raise ConfigError('%s::max_reconnect_delay must not be less than %s::reconnect_delay' % (self.section, self.section))
+
+        self.max_pending = self.get_integer_option('max_pending', self.default_max_pending)
+
+        self.connection = None
+        self.connected = False
+        self.pending = bytearray()
+        self.partial_left = 0 # bytes left of a record that was sent in part
+        self.report_ends = collections.deque() # [ offset into pending, publish time ] per report
+        self.last_progress = 0.0
+        self.connect_failures = 0
+        self.next_connect = 0.0
+        self.flush_at = None
+        self.timeout_at = None
+
+        # Resolved once, here. If the name does not resolve yet, it is
+        # tried again before each connect until it does.
+        self.address = None
+        try:
+            self.address = resolve_address(self.destination_addr, self.destination_port, socket.SOCK_STREAM)
+        except socket.error, why:
+            self.log.warn('Cannot resolve %s:%s yet: %s' % (self.destination_addr, self.destination_port, str(why)))
+
+    def setup_spool (self):
+        self.spool = None
+        self.replay_bytes = 0
+        self.next_replay = 0.0
+        spool_dir = self.reporter_config.get('spool_dir')
+        if not spool_dir:
+            return
+
+        max_size = self.get_integer_option('spool_max_size', self.default_spool_max_size)
+        max_age = self.get_seconds_option('spool_max_age', self.default_spool_max_age)
+        self.replay_rate = self.get_integer_option('spool_replay_rate', self.default_spool_replay_rate)
+        try:
+            self.spool = Spool(spool_dir, max_size, max_age, complete_length=self.complete_length)
+        except SpoolError, why:
+            raise ConfigError('%s::spool_dir: %s' % (self.section, str(why)))
+        self.spool.on_drop = self.spool_dropped
+        self.log.info('Spooling unsent reports to %s' % spool_dir)
+
+    def get_integer_option (self, option, default):
+        value = self.reporter_config.get(option)
+        if value is None:
+            return default
+        try:
+            value = convert_to_integer(value)
+        except ConversionError:
+            raise ConfigError('%s::%s must be an integer number' % (self.section, option))
+        if value <= 0:
+            raise ConfigError('%s::%s must be greater than zero' % (self.section, option))
+        return value
+
+    def get_seconds_option (self, option, default):
+        value = self.reporter_config.get(option)
+        if value is None:
+            return default
+        try:
+            value = convert_to_seconds(value)
+        except ConversionError:
+            raise ConfigError('%s::%s must be a time period' % (self.section, option))
+        if value <= 0:
+            raise ConfigError('%s::%s must be greater than zero' % (self.section, option))
+        return value
+
+    def deliver (self, snapshot):
+        message = snapshot.text(self.numeric_only)
+        if message:
+            self._send_tcp(message, snapshot.created)
+
+    def _send_tcp (self, message, created=None):
+        if self.spool is not None and self.connection is None and self.connect_failures:
+            # The destination is down
+            self.spool_data(message)
+            self.flush()
+            return
+
+        selfstats = self.metrics_recorder.selfstats
+        if len(self.pending) + len(message) > self.max_pending:
+            if self.spool is not None:
+                self.spool_data(message)
+                return
+            self.log.warn('Dropping a report: %d bytes of earlier reports are still unsent' % len(self.pending))
+            if selfstats is not None:
+                selfstats.mark_reporter_dropped(name=self.name)
+            return
+        if not self.pending:
+            self.last_progress = time.time()
+        self.pending += message
+        if created is not None:
+            self.report_ends.append([len(self.pending), created])
+        self.flush()
+
+    #
+    # The data sent is a stream of records, newline terminated lines here.
+    # Subclasses sending other records override these two.
+    #
+
+    def complete_length (self, data):
+        # The length of the complete records at the start of data
+        return data.rfind('\n') + 1
+
+    def record_remainder (self, sent):
+        # How much is left of the record the first sent bytes of the
+        # pending buffer ended in. Called before they are removed.
+        if self.pending[sent - 1] == ord('\n'):
+            return 0
+        return self.pending.find('\n', sent) + 1 - sent
+
+    def schedule_flush (self, delay):
+        # At most one flush is waiting on the reactor at a time. Only a
+        # reconnect or the next replay is ever waited for this way.
+        now = time.time()
+        if self.flush_at is not None and self.flush_at >= now:
+            return
+        self.flush_at = now + delay
+        get_reactor().call_later(delay, self.flush)
+
+    def flush (self):
+        now = time.time()
+        if not self.pending and (self.spool is None or not len(self.spool)):
+            return
+        if self.connection is None:
+            if now < self.next_connect:
+                self.schedule_flush(self.next_connect - now)
+            else:
+                self.connect(now)
+        elif self.connected:
+            if self.pending or self.replay(now):
+                self.write_pending()
+
+    def write_pending (self):
+        if not self.pending:
+            return
+        now = time.time()
+        try:
+            sent = self.connection.send(self.pending)
+        except socket.error, why:
+            if why[0] not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR, errno.ENOBUFS):
+                self.connection_lost(why)
+                return
+            sent = 0
+        if self.connection is None:
+            # Closed by the far end
+            return
 
-    def _send_tcp (self, message):
+        if sent:
+            self.partial_left = self.record_remainder(sent)
+            del self.pending[:sent]
+            self.pending_sent(sent, now)
+            self.last_progress = now
+            self.connect_failures = 0
+            if self.metrics_recorder.selfstats is not None:
+                self.metrics_recorder.selfstats.mark_reporter_sent(sent, name=self.name)
+            if self.replay_bytes:
+                replayed = min(sent, self.replay_bytes)
+                self.spool.commit(replayed)
+                self.replay_bytes -= replayed
+
+        if self.pending:
+            # The reactor calls again once the socket takes more
+            self.schedule_timeout(now)
+        elif self.spool is not None and len(self.spool):
+            self.flush()
+
+    def pending_sent (self, nbytes, now):
+        # The first nbytes of the pending buffer are gone. The reports that
+        # ended in them are sent, and their latency is recorded.
+        report_ends = self.report_ends
+        if not report_ends:
+            return
+        for end in report_ends:
+            end[0] -= nbytes
+        selfstats = self.metrics_recorder.selfstats
+        while report_ends and report_ends[0][0] <= 0:
+            _end, created = report_ends.popleft()
+            if selfstats is not None:
+                selfstats.mark_reporter_latency(now - created, name=self.name)
+
+    def replay (self, now):
+        # Moves the next stretch of the spool into the (empty) pending
+        # buffer, to be sent ahead of any report that comes meanwhile. It
+        # is only committed to the spool as it is sent.
+        if now < self.next_replay:
+            self.schedule_flush(self.next_replay - now)
+            return False
+        data = self.spool.read(self.replay_rate)
+        if not data:
+            return False
+        self.pending += data
+        self.replay_bytes = len(data)
+        self.last_progress = now
+        self.next_replay = now + len(data) / float(self.replay_rate)
+        return True
+
+    def spool_data (self, data):
+        self.spool.append(data)
+        if self.metrics_recorder.selfstats is not None:
+            self.metrics_recorder.selfstats.mark_reporter_spooled(len(data), name=self.name)
+
+    def spool_pending (self):
+        # After a failure, the unsent part of the pending buffer goes to the
+        # spool. Replayed data, at the front of the buffer, was never taken
+        # out of the spool and need only be dropped from the buffer. If the
+        # failure came part way through a record, the rest of that record
+        # is no use any more.
+        if self.replay_bytes:
+            if self.partial_left:
+                self.spool.commit(self.partial_left)
+            del self.pending[:self.replay_bytes]
+        else:
+            del self.pending[:self.partial_left]
+        if self.pending:
+            self.spool_data(str(self.pending))
+        del self.pending[:]
+        self.report_ends.clear()
+        self.replay_bytes = 0
+        self.partial_left = 0
+
+    def spool_dropped (self, nbytes):
+        if self.metrics_recorder.selfstats is not None:
+            self.metrics_recorder.selfstats.mark_reporter_spool_dropped(nbytes, name=self.name)
+
+    def connect (self, now):
         try:
-            sock = TCPReactable(address=(self.destination_addr, self.destination_port))
-            sock.create_socket()
-            sock.write_data(message)
-            sock.close_when_done()
+            if self.address is None:
+                self.address = resolve_address(self.destination_addr, self.destination_port, socket.SOCK_STREAM)
+            family, address = self.address
+            self.connected = False
+            self.last_progress = now
+            connection = ReporterConnection(self, address=address)
+            connection.create_socket(family, socket.SOCK_STREAM)
+            connection.socket.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            self.connection = connection
+            connection.connect(address)
         except socket.error, why:
-            self.log.warn('Failed to send report: %s' % str(why))
+            self.connect_failed(why)
+            return
+        self.schedule_timeout(now)
+
+    def connection_made (self):
+        self.log.info('Connected to %s:%s' % (self.destination_addr, self.destination_port))
+        self.connected = True
+        self.last_progress = time.time()
+        if self.partial_left:
+            # The previous connection was lost part way through a record.
+            # The rest of that record is no use on a new connection.
+            del self.pending[:self.partial_left]
+            self.pending_sent(self.partial_left, self.last_progress)
+            self.partial_left = 0
+        if self.metrics_recorder.selfstats is not None:
+            self.metrics_recorder.selfstats.mark_reporter_connect(name=self.name)
+        self.flush()
+
+    def connection_failed (self, why):
+        if self.connection is None:
+            return
+        if self.connected:
+            self.connection_lost(why)
+        else:
+            self.connect_failed(why)
+
+    def connect_failed (self, why):
+        delay = self.backoff()
+        self.log.warn('Failed to connect to %s:%s: %s. Retrying in %.1f seconds' % (self.destination_addr,
+                                                                                    self.destination_port,
+                                                                                    str(why), delay))
+        if self.metrics_recorder.selfstats is not None:
+            self.metrics_recorder.selfstats.mark_reporter_connect_failure(name=self.name)
+
+    def connection_lost (self, why):
+        delay = self.backoff()
+        self.log.warn('Lost connection to %s:%s: %s. Reconnecting in %.1f seconds' % (self.destination_addr,
+                                                                                      self.destination_port,
+                                                                                      str(why), delay))
+
+    def backoff (self):
+        # The delay doubles with every failure in a row, up to
+        # max_reconnect_delay, and is spread over its upper half so that
+        # many hosts do not reconnect in step. Only a successful send
+        # resets it, so a relay that accepts and then drops connections
+        # is backed off too.
+        self.close_connection()
+        if self.spool is not None:
+            self.spool_pending()
+        delay = min(self.max_reconnect_delay, self.reconnect_delay * (2 ** min(self.connect_failures, 30)))
+        delay = random.uniform(delay / 2.0, delay)
+        self.connect_failures += 1
+        self.next_connect = time.time() + delay
+        self.schedule_flush(delay)
+        return delay
+
+    def schedule_timeout (self, now):
+        # A connection is checked on send_timeout after its last progress.
+        # At most one check is waiting on the reactor at a time.
+        if self.timeout_at is not None and self.timeout_at >= now:
+            return
+        self.timeout_at = self.last_progress + self.send_timeout
+        get_reactor().call_later(max(0, self.timeout_at - now), self.check_timeout)
+
+    def check_timeout (self):
+        self.timeout_at = None
+        if self.connection is None or (self.connected and not self.pending):
+            return
+        now = time.time()
+        if now - self.last_progress < self.send_timeout:
+            self.schedule_timeout(now)
+        elif self.connected:
+            self.send_timed_out()
+        else:
+            self.connect_failed('connect timed out')
+
+    def send_timed_out (self):
+        if self.spool is not None:
+            self.log.warn('Send to %s:%s timed out. Spooling %d bytes of reports' % (self.destination_addr,
+                                                                                  self.destination_port,
+                                                                                  len(self.pending)))
+            self.spool_pending()
+        else:
+            self.log.warn('Send to %s:%s timed out. Dropping %d bytes of reports' % (self.destination_addr,
+                                                                                  self.destination_port,
+                                                                                  len(self.pending)))
+            del self.pending[:]
+            self.report_ends.clear()
+            self.partial_left = 0
+        self.close_connection()
+        if self.metrics_recorder.selfstats is not None:
+            self.metrics_recorder.selfstats.mark_reporter_send_timeout(name=self.name)
+
+    def close_connection (self):
+        if self.connection is not None:
+            try:
+                self.connection.close()
+            except socket.error:
+                pass
+        self.connection = None
+        self.connected = False
 
 class GraphiteReporter (TcpReporter):
     """Do not break old configurations..."""
 
+    # Graphite only takes numbers
+    numeric_only = True
+
     default_graphite_server = 'localhost'
     default_graphite_port   = 2003
 
@@ -148,7 +792,7 @@ class GraphiteReporter (TcpReporter):
                                  % self.default_graphite_server)
                 self.destination_addr = self.default_graphite_server
             else:
-                raise ConfigError('reporter::graphite_server must be specified')
+                raise ConfigError('%s::graphite_server must be specified' % self.section)
         else:
             self.destination_addr = destination_addr
 
@@ -159,55 +803,336 @@ class GraphiteReporter (TcpReporter):
                                  % self.default_graphite_port)
                 self.destination_port = self.default_graphite_port
             else:
-                raise ConfigError('reporter::graphite_port must be specified')
+                raise ConfigError('%s::graphite_port must be specified' % self.section)
         else:
             try:
                 self.destination_port = convert_to_integer(destination_port)
             except ConversionError:
-                raise ConfigError('reporter::graphite_port must be an integer number')
+                raise ConfigError('%s::graphite_port must be an integer number' % self.section)
 
         self.log.info('Reporting to graphite server : %s:%s' % (self.destination_addr,
                                                                 self.destination_port))
 
-    def send_report (self):
-        lines = self.metrics_recorder.publish()
-        message = '\n'.join([l for l in lines if not l.split()[1].startswith('"')]) + '\n'
-        self._send_tcp(message)
+# Every pickle sent to carbon is preceded by its length
+PICKLE_HEADER = struct.Struct('!L')
+
+def pickle_datapoints (datapoints, batch_size):
+    # Length prefixed pickles of at most batch_size datapoints each
+    pickler = cPickle.Pickler(cPickle.HIGHEST_PROTOCOL)
+    pickler.fast = 1
+    frames = []
+    for start in xrange(0, len(datapoints), batch_size):
+        pickler.dump(datapoints[start:start + batch_size])
+        payload = pickler.getvalue()
+        frames.append(PICKLE_HEADER.pack(len(payload)))
+        frames.append(payload)
+    return ''.join(frames)
+
+class GraphitePickleReporter (GraphiteReporter):
+    """
+    Sends reports to carbon's pickle receiver, as pickled lists of
+    (path, (timestamp, value)) tuples taken straight from the metrics.
+    No report lines are formatted. A report is sent in batches of at most
+    batch_size datapoints.
+    """
+
+    default_graphite_port = 2004
+    default_batch_size    = 500 # datapoints
+
+    def setup (self):
+        super(GraphitePickleReporter, self).setup()
+        self.batch_size = self.get_integer_option('batch_size', self.default_batch_size)
+
+    def deliver (self, snapshot):
+        message = snapshot.pickles(self.batch_size)
+        if message:
+            self._send_tcp(message, snapshot.created)
+
+    #
+    # The records are length prefixed pickles. Frame boundaries are found by
+    # following the length headers on from the first whole frame.
+    #
+
+    def complete_length (self, data):
+        end = 0
+        while end + PICKLE_HEADER.size <= len(data):
+            frame_end = end + PICKLE_HEADER.size + PICKLE_HEADER.unpack_from(data, end)[0]
+            if frame_end > len(data):
+                break
+            end = frame_end
+        return end
+
+    def record_remainder (self, sent):
+        pending = self.pending
+        position = self.partial_left
+        while position < sent:
+            position += PICKLE_HEADER.size + PICKLE_HEADER.unpack_from(pending, position)[0]
+        return position - sent
 
 ##############################################################################
 
-class MulticastReporter (BaseReporter):
+# Largest UDP payload over IPv4
+MAX_DATAGRAM_SIZE = 65507
+
+def pack_datagrams (data, max_size):
+    """
+    Splits newline terminated lines into datagrams of at most max_size
+    bytes, breaking only between lines. Lines longer than max_size cannot
+    be sent whole and are left out. Returns the datagrams and the number of
+    lines left out.
+    """
+    datagrams = []
+    oversized = 0
+    start = 0
+    end = len(data)
+    while start < end:
+        if end - start <= max_size:
+            datagrams.append(data[start:])
+            break
+        cut = data.rfind('\n', start, start + max_size) + 1
+        if cut > start:
+            datagrams.append(data[start:cut])
+            start = cut
+            continue
+        oversized += 1
+        newline = data.find('\n', start)
+        if newline < 0:
+            break
+        start = newline + 1
+    return datagrams, oversized
+
+def pack_records (records, max_size):
+    """
+    Packs records into datagrams of at most max_size bytes, never splitting
+    a record. A record is one or more newline terminated lines that must
+    arrive together. Records longer than max_size are left out. Returns the
+    datagrams and the number of records left out.
+    """
+    datagrams = []
+    oversized = 0
+    batch = []
+    size = 0
+    for record in records:
+        length = len(record)
+        if length > max_size:
+            oversized += 1
+            continue
+        if size + length > max_size:
+            datagrams.append(''.join(batch))
+            batch = []
+            size = 0
+        batch.append(record)
+        size += length
+    if batch:
+        datagrams.append(''.join(batch))
+    return datagrams, oversized
+
+class DatagramReporter (BaseReporter):
+    """
+    Sends each report as UDP datagrams of at most max_packet_size bytes,
+    packed with whole lines, over one socket kept for the life of the
+    reporter. Datagrams the socket refuses are dropped and counted.
+    """
+
+    default_max_packet_size = 1432 # bytes, fits a 1500 byte ethernet MTU
+
+    records_latency = True
 
     def setup (self):
-        super(MulticastReporter, self).setup()
+        super(DatagramReporter, self).setup()
         self.setup_address()
+        self.setup_packet_size()
+        self.sock = None
+
+        # Resolved once, here, or on the first send if it fails now
+        self.address = None
+        host, port = self.get_address()
+        try:
+            self.address = resolve_address(host, port, socket.SOCK_DGRAM)
+        except socket.error, why:
+            self.log.warn('Cannot resolve %s:%s yet: %s' % (host, port, str(why)))
+
+    def setup_address (self):
+        pass
+
+    def setup_packet_size (self):
+        max_packet_size = self.reporter_config.get('max_packet_size')
+        if max_packet_size is None:
+            self.max_packet_size = self.default_max_packet_size
+            return
+        try:
+            self.max_packet_size = convert_to_integer(max_packet_size)
+        except ConversionError:
+            raise ConfigError('%s::max_packet_size must be an integer number' % self.section)
+        if not 0 < self.max_packet_size <= MAX_DATAGRAM_SIZE:
+            raise ConfigError('%s::max_packet_size must be between 1 and %d' % (self.section, MAX_DATAGRAM_SIZE))
+
+    def get_address (self):
+        raise NotImplementedError
+
+    def create_socket (self):
+        if self.address is None:
+            host, port = self.get_address()
+            self.address = resolve_address(host, port, socket.SOCK_DGRAM)
+        family, address = self.address
+        sock = socket.socket(family, socket.SOCK_DGRAM)
+        sock.setblocking(0)
+        self.configure_socket(sock)
+        sock.connect(address)
+        return sock
+
+    def configure_socket (self, sock):
+        pass
+
+    def build_datagrams (self, snapshot):
+        # The datagrams of a report, and the number of lines left out of
+        # them for being too long
+        return pack_datagrams(snapshot.text(self.numeric_only), self.max_packet_size)
+
+    def deliver (self, snapshot):
+        datagrams, oversized = self.build_datagrams(snapshot)
+        if datagrams or oversized:
+            self.send_datagrams(datagrams, oversized, snapshot.created)
+
+    def send_datagrams (self, datagrams, oversized=0, created=None):
+        sent = dropped = nbytes = 0
+        try:
+            if self.sock is None:
+                self.sock = self.create_socket()
+            send = self.sock.send
+            for datagram in datagrams:
+                try:
+                    nbytes += send(datagram)
+                    sent += 1
+                except socket.error, why:
+                    if why[0] == errno.EMSGSIZE:
+                        oversized += 1
+                    elif why[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.ENOBUFS, errno.ECONNREFUSED, errno.EINTR):
+                        # The socket buffer is full, or an earlier datagram
+                        # was refused. This datagram is lost either way.
+                        dropped += 1
+                    else:
+                        raise
+        except socket.error, why:
+            self.log.warn('Failed to send report: %s' % str(why))
+            dropped = len(datagrams) - sent
+            self.close_socket()
+
+        if oversized:
+            self.log.warn('Dropped %d report lines longer than max_packet_size (%d bytes)' % (oversized,
+                                                                                              self.max_packet_size))
+        selfstats = self.metrics_recorder.selfstats
+        if selfstats is not None:
+            selfstats.mark_reporter_sent(nbytes, name=self.name)
+            selfstats.mark_reporter_datagrams(sent, dropped, oversized, name=self.name)
+            if sent and created is not None:
+                selfstats.mark_reporter_latency(time.time() - created, name=self.name)
+
+    def close_socket (self):
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except socket.error:
+                pass
+        self.sock = None
+
+class UdpReporter (DatagramReporter):
+    """
+    Sends the report lines as they are, as a Graphite UDP listener takes
+    them.
+    """
+
+    # Graphite only takes numbers
+    numeric_only = True
+
+    default_destination_addr = None
+    default_destination_port = None
+
+    def setup_address (self):
+        destination_addr = self.reporter_config.get('destination_addr')
+        if destination_addr is None:
+            if self.default_destination_addr is not None:
+                self.log.warning('no destination_addr specified for %s. Using default: %s'
+                                 % (self.__class__.__name__, self.default_destination_addr))
+                self.destination_addr = self.default_destination_addr
+            else:
+                raise ConfigError('%s::destination_addr must be specified' % self.section)
+        else:
+            self.destination_addr = destination_addr
+
+        destination_port = self.reporter_config.get('destination_port')
+        if destination_port is None:
+            if self.default_destination_port is not None:
+                self.log.warning('no destination_port specified for %s. Using default: %s'
+                                 % (self.__class__.__name__, self.default_destination_port))
+                self.destination_port = self.default_destination_port
+            else:
+                raise ConfigError('%s::destination_port must be specified' % self.section)
+        else:
+            try:
+                self.destination_port = convert_to_integer(destination_port)
+            except ConversionError:
+                raise ConfigError('%s::destination_port must be an integer number' % self.section)
+
+        self.log.info('Reporting to udp address: %s:%s' % (self.destination_addr,
+                                                           self.destination_port))
+
+    def get_address (self):
+        return (self.destination_addr, self.destination_port)
+
+class StatsdReporter (UdpReporter):
+    """
+    Sends every numeric report field to a StatsD server as a gauge. Squib
+    has already done the aggregation.
+
+    StatsD reads a negative gauge value as a change to the gauge, so a
+    negative value is sent right after setting the gauge to zero, in the
+    same datagram.
+    """
+
+    default_destination_addr = 'localhost'
+    default_destination_port = 8125
+
+    def build_datagrams (self, snapshot):
+        records = []
+        append = records.append
+        for path, (_ts, value) in snapshot.datapoints():
+            if value < 0:
+                append('%s:0|g\n%s:%s|g\n' % (path, path, value))
+            else:
+                append('%s:%s|g\n' % (path, value))
+        return pack_records(records, self.max_packet_size)
+
+##############################################################################
+
+class MulticastReporter (DatagramReporter):
 
     def setup_address (self):
         self.multicast_addr = self.reporter_config.get('multicast_addr')
         if not self.multicast_addr:
-            raise ConfigError('reporter::multicast_addr must be specified')
+            raise ConfigError('%s::multicast_addr must be specified' % self.section)
 
         self.multicast_port = self.reporter_config.get('multicast_port')
         if not self.multicast_port:
-            raise ConfigError('reporter::multicast_port must be specified')
+            raise ConfigError('%s::multicast_port must be specified' % self.section)
         else:
             try:
                 self.multicast_port = convert_to_integer(self.multicast_port)
             except ConversionError:
-                raise ConfigError('reporter::multicast_port must be an integer number')
+                raise ConfigError('%s::multicast_port must be an integer number' % self.section)
 
         self.multicast_ttl = self.reporter_config.get('multicast_ttl')
         if self.multicast_ttl:
             try:
                 self.multicast_ttl = convert_to_integer(self.multicast_ttl)
             except ConversionError:
-                raise ConfigError('reporter::multicast_ttl must be an integer number')
+                raise ConfigError('%s::multicast_ttl must be an integer number' % self.section)
 
         self.multicast_loopback = self.reporter_config.get('multicast_loopback', True)
         try:
             self.multicast_loopback = convert_to_bool(self.multicast_loopback)
         except ConversionError:
-            raise ConfigError('reporter::multicast_loopback must be a boolean')
+            raise ConfigError('%s::multicast_loopback must be a boolean' % self.section)
 
 
         self.log.info('Reporting to multicast address:  %s:%s' % (self.multicast_addr,
@@ -217,31 +1142,31 @@ class MulticastReporter (BaseReporter):
         if self.multicast_loopback == False:
             self.log.info('MulticastReporter will NOT send reports to this machine (multicast_loopback = False)')
 
-    def send_report (self):
-        lines = self.metrics_recorder.publish()
-        message = '\n'.join(lines) + '\n'
-        try:
-            address=(self.multicast_addr, self.multicast_port)
-            sock = MulticastReactable(address)
-            sock.create_socket()
-            if self.multicast_ttl:
-                sock.set_ttl(self.multicast_ttl)
-            sock.set_loopback_mode(self.multicast_loopback)
-            sock.write_data(message)
-            sock.close_when_done()
-        except socket.error, why:
-            self.log.warn('Failed to send report: %s' % str(why))
+    def get_address (self):
+        return (self.multicast_addr, self.multicast_port)
+
+    def configure_socket (self, sock):
+        if self.multicast_ttl:
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, self.multicast_ttl)
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, int(self.multicast_loopback))
 
 ##############################################################################
 
 class PollableReporter (BaseReporter):
+    """
+    Keeps the latest report for whoever polls for it. A poll always gets the
+    full report, so changes_only does not apply.
+    """
 
     def setup (self):
         super(PollableReporter, self).setup()
+        if self.changes_only:
+            self.log.warning('A pollable reporter always serves full reports. Ignoring changes_only')
+            self.changes_only = False
         self.current_report = []
 
-    def send_report (self):
-        self.current_report = self.metrics_recorder.publish()
+    def deliver (self, snapshot):
+        self.current_report = snapshot.full_lines(self.numeric_only)
 
     def get_current_report (self):
         return self.current_report
@@ -265,7 +1190,7 @@ class WebPollableReporter (PollableReporter):
                                  % self.default_server_addr)
                 self.server_addr = self.default_server_addr
             else:
-                raise ConfigError('reporter::server_addr must be specified')
+                raise ConfigError('%s::server_addr must be specified' % self.section)
         else:
             self.server_addr = server_addr
 
@@ -276,12 +1201,12 @@ class WebPollableReporter (PollableReporter):
                                  % self.default_server_port)
                 self.server_port = self.default_server_port
             else:
-                raise ConfigError('reporter::server_port must be specified')
+                raise ConfigError('%s::server_port must be specified' % self.section)
         else:
             try:
                 self.server_port = convert_to_integer(server_port)
             except ConversionError:
-                raise ConfigError('reporter::server_port must be an integer number')
+                raise ConfigError('%s::server_port must be an integer number' % self.section)
 
         httpserver = SquibHTTPServer(address=(self.server_addr, self.server_port), reporter=self).activate()
 
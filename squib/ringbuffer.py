@@ -0,0 +1,143 @@
+# vim:set ts=4 sw=4 et nowrap syntax=python ff=unix:
+#
+# Copyright 2011-2018 Mark Crewson <mark@crewson.net>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import struct, sys, time
+
+try:
+    import mmap
+except ImportError:
+    mmap = None
+
+from squib import wire
+
+##############################################################################
+#
+# A single-producer/single-consumer ring buffer in an anonymous shared
+# mmap. It is created in the parent before the oxidizer is forked, so the
+# child inherits the same mapping.
+#
+# The first cache line holds two free-running byte counters: 'head' is only
+# ever written by the producer (the oxidizer child) and 'tail' is only ever
+# written by the consumer (the parent). A producer copies its data in and
+# then publishes the new head; the consumer copies data out and then
+# publishes the new tail.
+#
+
+RING_INDEX  = struct.Struct('Q')
+HEAD_OFFSET = 0
+TAIL_OFFSET = 8
+DATA_OFFSET = 64
+
+MIN_RING_SIZE = 2 * wire.MAX_FRAME_LENGTH
+
+class RingBufferError (Exception):
+    pass
+
+class RingBuffer (object):
+
+    def __init__ (self, capacity):
+        if mmap is None:
+            raise RingBufferError('mmap is not available')
+        if capacity < MIN_RING_SIZE:
+            raise RingBufferError('ring buffers must be at least %d bytes' % MIN_RING_SIZE)
+        self.capacity = capacity
+        try:
+            self.mm = mmap.mmap(-1, DATA_OFFSET + capacity)
+        except (EnvironmentError, ValueError), why:
+            raise RingBufferError(str(why))
+
+    def write (self, data):
+        # Producer side. All or nothing: returns False if the data does not
+        # fit in the free space right now.
+        mm = self.mm
+        head = RING_INDEX.unpack_from(mm, HEAD_OFFSET)[0]
+        tail = RING_INDEX.unpack_from(mm, TAIL_OFFSET)[0]
+        size = len(data)
+        if size > self.capacity - (head - tail):
+            return False
+
+        start = head % self.capacity
+        first = min(size, self.capacity - start)
+        mm[DATA_OFFSET+start:DATA_OFFSET+start+first] = data[:first]
+        if first < size:
+            mm[DATA_OFFSET:DATA_OFFSET+size-first] = data[first:]
+        RING_INDEX.pack_into(mm, HEAD_OFFSET, head + size)
+        return True
+
+    def read (self):
+        # Consumer side. Returns everything currently in the ring.
+        mm = self.mm
+        head = RING_INDEX.unpack_from(mm, HEAD_OFFSET)[0]
+        tail = RING_INDEX.unpack_from(mm, TAIL_OFFSET)[0]
+        size = head - tail
+        if size == 0:
+            return ''
+
+        start = tail % self.capacity
+        first = min(size, self.capacity - start)
+        data = mm[DATA_OFFSET+start:DATA_OFFSET+start+first]
+        if first < size:
+            data += mm[DATA_OFFSET:DATA_OFFSET+size-first]
+        RING_INDEX.pack_into(mm, TAIL_OFFSET, head)
+        return data
+
+##############################################################################
+
+class RingEmitter (wire.BinaryEmitter):
+    """
+    Writes binary frames into a RingBuffer instead of stdout. A newline is
+    written to stdout after each flush, as a doorbell telling the parent
+    to drain the ring.
+    """
+
+    full_wait = 0.001 # seconds
+
+    def __init__ (self, ring):
+        super(RingEmitter, self).__init__()
+        self.ring = ring
+
+    def flush (self):
+        frames = self.frames
+        if frames:
+            self.frames = []
+            data = ''.join(frames)
+            if len(data) <= self.ring.capacity:
+                self.write(data)
+            else:
+                # Never split a frame across writes. The parent must only
+                # ever see whole frames, even if this child dies mid-flush.
+                chunk, chunk_size = [], 0
+                for frame in frames:
+                    if chunk_size + len(frame) > self.ring.capacity:
+                        self.write(''.join(chunk))
+                        chunk, chunk_size = [], 0
+                    chunk.append(frame)
+                    chunk_size += len(frame)
+                self.write(''.join(chunk))
+        self.doorbell()
+
+    def write (self, data):
+        while not self.ring.write(data):
+            # Full. Like a blocked pipe, wait for the parent to drain it
+            self.doorbell()
+            time.sleep(self.full_wait)
+
+    def doorbell (self):
+        sys.stdout.write('\n')
+        sys.stdout.flush()
+
+##############################################################################
+## THE END
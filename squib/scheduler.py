@@ -0,0 +1,168 @@
+# vim:set ts=4 sw=4 et nowrap syntax=python ff=unix:
+#
+# Copyright 2011-2018 Mark Crewson <mark@crewson.net>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import math, os, random, time, traceback
+
+##############################################################################
+
+class TimerWheel (object):
+    """
+    A hierarchical timer wheel. Level 0 has one slot per tick, and every
+    level above it has slots that are 'slots' times wider. Timers are
+    cascaded down a level each time the level below wraps around.
+    """
+
+    def __init__ (self, resolution=0.1, slots=64, levels=4, now=None):
+        if now is None:
+            now = time.time()
+        self.resolution = resolution
+        self.slots = slots
+        self.levels = levels
+        self.wheels = [ [ [] for s in range(slots) ] for l in range(levels) ]
+        self.overflow = []
+        self.current_tick = int(now / resolution)
+
+    def schedule (self, when, item):
+        tick = int(math.ceil(when / self.resolution))
+        if tick <= self.current_tick:
+            tick = self.current_tick + 1
+        self.insert(tick, item)
+
+    def insert (self, tick, item):
+        delta = tick - self.current_tick
+        span = self.slots
+        for level in range(self.levels):
+            if delta < span:
+                slot = (tick // (span // self.slots)) % self.slots
+                self.wheels[level][slot].append((tick, item))
+                return
+            span *= self.slots
+        self.overflow.append((tick, item))
+
+    def advance (self, now):
+        """Move the wheel up to 'now', returning the items that expired."""
+        expired = []
+        target = int(now / self.resolution)
+        while self.current_tick < target:
+            self.current_tick += 1
+            tick = self.current_tick
+            self.cascade(tick)
+            slot = self.wheels[0][tick % self.slots]
+            if slot:
+                self.wheels[0][tick % self.slots] = []
+                expired.extend([ item for t, item in slot ])
+        return expired
+
+    def cascade (self, tick):
+        width = 1
+        for level in range(1, self.levels):
+            width *= self.slots
+            if tick % width != 0:
+                return
+            slot = (tick // width) % self.slots
+            entries = self.wheels[level][slot]
+            self.wheels[level][slot] = []
+            for t, item in entries:
+                self.insert(t, item)
+        if tick % (width * self.slots) == 0 and self.overflow:
+            entries, self.overflow = self.overflow, []
+            for t, item in entries:
+                self.insert(t, item)
+
+    def next_tick_time (self):
+        return (self.current_tick + 1) * self.resolution
+
+##############################################################################
+
+class ScheduledOxidizer (object):
+
+    def __init__ (self, oxidizer, jitter=0.0):
+        self.oxidizer = oxidizer
+        self.name = oxidizer.name
+        self.period = oxidizer.period
+        self.offset = random.uniform(0.0, min(jitter, self.period))
+        self.due = None
+        self.runs = 0
+        self.overruns = 0
+
+    def next_due (self, now):
+        # Align to wall-clock multiples of the period, shifted by the jitter
+        boundary = math.floor((now - self.offset) / self.period) + 1
+        return boundary * self.period + self.offset
+
+class OxidizerScheduler (object):
+    """
+    Hosts several periodic oxidizers in one process.
+    """
+
+    default_resolution = 0.1 # seconds
+
+    def __init__ (self, emitter, resolution=None):
+        if resolution is None:
+            resolution = self.default_resolution
+        self.emitter = emitter
+        self.wheel = TimerWheel(resolution)
+        self.scheduled = []
+
+    def add (self, oxidizer, jitter=0.0):
+        self.scheduled.append(ScheduledOxidizer(oxidizer, jitter))
+
+    def run (self):
+        now = time.time()
+        for sox in self.scheduled:
+            sox.due = sox.next_due(now)
+            self.wheel.schedule(sox.due, sox)
+
+        while True:
+            for sox in self.wheel.advance(time.time()):
+                self.run_scheduled(sox)
+            self.emitter.flush()
+            # No need to wake up on every tick, only when something is due
+            wake = min([ sox.due for sox in self.scheduled ])
+            wake = max(wake, self.wheel.next_tick_time())
+            delay = wake - time.time()
+            if delay > 0.0:
+                try:
+                    time.sleep(delay)
+                except (KeyboardInterrupt, SystemExit):
+                    break
+
+    def run_scheduled (self, sox):
+        start = time.time()
+        try:
+            sox.oxidizer.run_once()
+        except:
+            tb = traceback.format_exc()
+            os.write(2, '\'%s\' oxidizer threw an unexpected exception:\n%s' % (sox.name, tb))
+        done = time.time()
+        lateness = start - sox.due
+
+        sox.runs += 1
+        overrun = 0
+        if done - sox.due > sox.period:
+            # Missed at least one tick. Skip them rather than piling up
+            overrun = 1
+            sox.overruns += 1
+        sox.due = sox.next_due(max(done, sox.due))
+        self.wheel.schedule(sox.due, sox)
+
+        prefix = 'squib.scheduler.%s.' % sox.name
+        self.emitter.emit(prefix + 'duration', round(done - start, 6))
+        self.emitter.emit(prefix + 'lateness', round(lateness, 6))
+        self.emitter.emit(prefix + 'overruns', overrun, 'counter')
+
+##############################################################################
+## THE END
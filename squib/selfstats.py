@@ -19,9 +19,29 @@ import resource, time
 from mccorelib.baseobject import BaseObject
 from mccorelib.async      import get_reactor
 
+from squib import statistics
+
 ##############################################################################
 
+# (counter, metric name) of the counters a reporter can keep
+REPORTER_STATS = (('connect', 'connects'),
+                  ('connect_failure', 'connectFailures'),
+                  ('sent', 'bytesSent'),
+                  ('send_timeout', 'sendTimeouts'),
+                  ('dropped', 'dropped'),
+                  ('spooled', 'spooled'),
+                  ('spool_dropped', 'spoolDropped'),
+                  ('datagram', 'datagrams'),
+                  ('datagram_dropped', 'datagramsDropped'),
+                  ('oversized', 'oversized'))
+
 class SelfStatistics (BaseObject):
+    """
+    Squib's own metrics. The reporter counters are kept per reporter: the
+    reporter under squib.reporter, and each child of a composite reporter
+    under squib.reporter.<name>. A counter is only reported once it was
+    first counted, so reporters only report the counters they use.
+    """
 
     announce_period = 3
 
@@ -35,25 +55,94 @@ class SelfStatistics (BaseObject):
     def setup (self):
         self.metric_record_stat = 0
         self.metric_report_stat = 0
-        
+        self.metric_evicted_stat = 0
+        self.metric_overflow_stat = 0
+        self.metric_expired_stat = 0
+        self.reporter_stats = {}
+
         rusage = resource.getrusage(resource.RUSAGE_SELF)
         self.last_cpu_usage = rusage.ru_utime + rusage.ru_stime
         self.last_time  = time.time()
 
         self.reactor.call_later(self.announce_period, self.announce)
 
-    def mark_metrics_record (self):
-        self.metric_record_stat += 1
+    def mark_metrics_record (self, count=1):
+        self.metric_record_stat += count
 
     def mark_metrics_report (self):
         self.metric_report_stat += 1
 
+    def mark_metrics_evicted (self, count=1):
+        self.metric_evicted_stat += count
+
+    def mark_metrics_overflow (self):
+        self.metric_overflow_stat += 1
+
+    def mark_metrics_expired (self, count=1):
+        self.metric_expired_stat += count
+
+    def count_reporter (self, name, counter, count):
+        if not count:
+            return
+        stats = self.reporter_stats.get(name)
+        if stats is None:
+            stats = self.reporter_stats[name] = {}
+        stats[counter] = stats.get(counter, 0) + count
+
+    def reporter_metric_name (self, name, metric):
+        if name is None:
+            return 'squib.reporter.%s' % metric
+        return 'squib.reporter.%s.%s' % (name, metric)
+
+    def mark_reporter_connect (self, name=None):
+        self.count_reporter(name, 'connect', 1)
+
+    def mark_reporter_connect_failure (self, name=None):
+        self.count_reporter(name, 'connect_failure', 1)
+
+    def mark_reporter_sent (self, nbytes, name=None):
+        self.count_reporter(name, 'sent', nbytes)
+
+    def mark_reporter_send_timeout (self, name=None):
+        self.count_reporter(name, 'send_timeout', 1)
+
+    def mark_reporter_dropped (self, count=1, name=None):
+        self.count_reporter(name, 'dropped', count)
+
+    def mark_reporter_spooled (self, nbytes, name=None):
+        self.count_reporter(name, 'spooled', nbytes)
+
+    def mark_reporter_spool_dropped (self, nbytes, name=None):
+        self.count_reporter(name, 'spool_dropped', nbytes)
+
+    def mark_reporter_datagrams (self, sent, dropped, oversized, name=None):
+        self.count_reporter(name, 'datagram', sent)
+        self.count_reporter(name, 'datagram_dropped', dropped)
+        self.count_reporter(name, 'oversized', oversized)
+
+    def mark_reporter_latency (self, seconds, name=None):
+        # The time from a publish until its report was sent, in milliseconds
+        recorder = self.metrics_recorder
+        timer = recorder.lookup_metric(self.reporter_metric_name(name, 'latency'), 'timer')
+        timer.update_number(seconds * 1000.0)
+        timer.last_update = time.time()
+        recorder.mark_recorded(1)
+
     def announce (self):
         try:
             self.metrics_recorder.record('squib.metrics.record', 'derivgauge %d' % self.metric_record_stat)
             self.metrics_recorder.record('squib.metrics.record', 'derivmeter %d' % self.metric_record_stat)
             self.metrics_recorder.record('squib.metrics.report', 'derivgauge %d' % self.metric_report_stat)
             self.metrics_recorder.record('squib.metrics.report', 'derivmeter %d' % self.metric_report_stat)
+            self.metrics_recorder.record('squib.metrics.evicted', 'derivmeter %d' % self.metric_evicted_stat)
+            self.metrics_recorder.record('squib.metrics.overflow', 'derivmeter %d' % self.metric_overflow_stat)
+            self.metrics_recorder.record('squib.metrics.expired', 'derivmeter %d' % self.metric_expired_stat)
+            for name, stats in self.reporter_stats.items():
+                for counter, metric in REPORTER_STATS:
+                    if counter in stats:
+                        self.metrics_recorder.record(self.reporter_metric_name(name, metric), 'derivmeter %d' % stats[counter])
+            self.metrics_recorder.record('squib.metrics.count', 'gauge %d' % len(self.metrics_recorder.all_metrics))
+            self.metrics_recorder.record('squib.metrics.ewmas', 'gauge %d' % statistics.meter_engine.size())
             self.metrics_recorder.record('squib.cpuUsage', 'gauge %2.2f' % self.get_cpu_usage())
             self.metrics_recorder.record('squib.memUsage', 'gauge %2.2f' % self.get_mem_usage())
 
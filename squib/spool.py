@@ -0,0 +1,210 @@
+# vim:set ts=4 sw=4 et nowrap syntax=python ff=unix:
+#
+# Copyright 2011-2018 Mark Crewson <mark@crewson.net>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os, time
+
+from mccorelib.log import getlog
+
+##############################################################################
+#
+# An on-disk spool of reports that could not be sent. Reports are appended
+# to numbered segment files in the spool directory and read back, oldest
+# first, in whole records. Data read from the spool stays in it until it is
+# committed, so a replay that fails part way is simply read again.
+#
+# The spool is bounded: when it grows past max_size, or its oldest segment
+# was last written more than max_age seconds ago, whole segments are
+# dropped, oldest first. Segments left over from an earlier run are
+# replayed from their start.
+#
+
+SEGMENT_PREFIX = 'spool.'
+
+class SpoolError (Exception):
+    pass
+
+class Spool (object):
+
+    default_segment_size = 1024 * 1024 # bytes
+
+    def __init__ (self, directory, max_size, max_age=None, segment_size=None, complete_length=None):
+        self.log = getlog()
+        self.directory = directory
+        self.max_size = max_size
+        self.max_age = max_age
+        if segment_size is None:
+            segment_size = self.default_segment_size
+        self.segment_size = max(1, min(segment_size, max_size // 4))
+        if complete_length is not None:
+            # Tells the length of the complete records at the start of
+            # some data. Records are newline terminated lines by default.
+            self.complete_length = complete_length
+        self.segments = []    # [ sequence, size, last write time ] per segment, oldest first
+        self.read_offset = 0  # into the oldest segment
+        self.reading = None   # the segment the last read() came from
+        self.size = 0         # bytes not yet committed
+        self.writer = None
+        self.on_drop = None   # called with the number of bytes dropped
+        self.open_spool()
+
+    def open_spool (self):
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            names = os.listdir(self.directory)
+        except OSError, why:
+            raise SpoolError('Cannot open spool directory %s: %s' % (self.directory, str(why)))
+
+        for name in names:
+            if not name.startswith(SEGMENT_PREFIX): continue
+            try:
+                sequence = int(name[len(SEGMENT_PREFIX):])
+                st = os.stat(self.segment_path(sequence))
+            except (ValueError, OSError):
+                continue
+            self.segments.append([sequence, st.st_size, st.st_mtime])
+            self.size += st.st_size
+        self.segments.sort()
+        if self.segments:
+            self.log.info('Spool %s holds %d bytes of unsent reports' % (self.directory, self.size))
+        self.enforce_limits(time.time())
+
+    def segment_path (self, sequence):
+        return os.path.join(self.directory, '%s%010d' % (SEGMENT_PREFIX, sequence))
+
+    def __len__ (self):
+        return self.size
+
+    def complete_length (self, data):
+        return data.rfind('\n') + 1
+
+    def append (self, data):
+        now = time.time()
+        try:
+            if self.writer is None or self.segments[-1][1] >= self.segment_size:
+                self.start_segment(now)
+            self.writer.write(data)
+            self.writer.flush()
+        except (IOError, OSError), why:
+            self.log.warn('Cannot write to spool %s: %s. Dropping %d bytes' % (self.directory, str(why), len(data)))
+            self.close_writer()
+            self.mark_dropped(len(data))
+            return
+        segment = self.segments[-1]
+        segment[1] += len(data)
+        segment[2] = now
+        self.size += len(data)
+        self.enforce_limits(now)
+
+    def start_segment (self, now):
+        self.close_writer()
+        if self.segments:
+            sequence = self.segments[-1][0] + 1
+        else:
+            sequence = 1
+        self.writer = open(self.segment_path(sequence), 'ab')
+        self.segments.append([sequence, 0, now])
+
+    def close_writer (self):
+        if self.writer is not None:
+            try:
+                self.writer.close()
+            except (IOError, OSError):
+                pass
+            self.writer = None
+
+    def read (self, max_bytes):
+        # Up to max_bytes of whole records from the start of the spool. A
+        # single record longer than max_bytes is read whole.
+        self.enforce_limits(time.time())
+        while self.segments:
+            sequence, size, _mtime = self.segments[0]
+            if self.read_offset < size:
+                break
+            if len(self.segments) == 1:
+                return ''
+            self.remove_segment()
+        else:
+            return ''
+
+        try:
+            fp = open(self.segment_path(sequence), 'rb')
+            try:
+                fp.seek(self.read_offset)
+                data = fp.read(max_bytes)
+                end = self.complete_length(data)
+                while end == 0:
+                    more = fp.read(max_bytes)
+                    if not more: break
+                    data += more
+                    end = self.complete_length(data)
+            finally:
+                fp.close()
+        except (IOError, OSError), why:
+            self.log.warn('Cannot read spool segment %s: %s. Dropping it' % (self.segment_path(sequence), str(why)))
+            self.drop_oldest()
+            return ''
+        if end == 0:
+            # A truncated record, from a write cut short in an earlier run
+            self.log.warn('Spool segment %s ends in a partial record' % self.segment_path(sequence))
+            self.drop_oldest()
+            return ''
+        self.reading = sequence
+        return data[:end]
+
+    def commit (self, nbytes):
+        # The first nbytes of what read() returned were sent. If that
+        # segment was dropped meanwhile, there is nothing left to commit.
+        if not self.segments or self.segments[0][0] != self.reading:
+            return
+        self.read_offset += nbytes
+        self.size -= nbytes
+        if self.read_offset >= self.segments[0][1] and len(self.segments) > 1:
+            self.remove_segment()
+
+    def enforce_limits (self, now):
+        while self.segments and self.size > self.max_size:
+            self.drop_oldest()
+        if self.max_age:
+            while self.segments and now - self.segments[0][2] > self.max_age:
+                self.drop_oldest()
+
+    def drop_oldest (self):
+        unread = self.segments[0][1] - self.read_offset
+        self.log.warn('Spool %s is over its limits. Dropping %d bytes of unsent reports' % (self.directory, unread))
+        self.remove_segment()
+        self.mark_dropped(unread)
+
+    def mark_dropped (self, nbytes):
+        if self.on_drop is not None:
+            self.on_drop(nbytes)
+
+    def remove_segment (self):
+        sequence, size, _mtime = self.segments.pop(0)
+        self.size -= size - self.read_offset
+        self.read_offset = 0
+        if not self.segments:
+            self.close_writer()
+        try:
+            os.unlink(self.segment_path(sequence))
+        except OSError, why:
+            self.log.warn('Cannot remove spool segment %s: %s' % (self.segment_path(sequence), str(why)))
+
+    def close (self):
+        self.close_writer()
+
+##############################################################################
+## THE END
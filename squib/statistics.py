@@ -14,7 +14,12 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import heapq, math, random, sys, time
+import array, bisect, heapq, math, random, sys, time, weakref
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 from mccorelib.async import get_reactor
 
@@ -26,11 +31,15 @@ M1_ALPHA  = 1 - math.exp(-EWMA_DECAY_INTERVAL / 60.0)
 M5_ALPHA  = 1 - math.exp(-EWMA_DECAY_INTERVAL / 60.0 / 5)
 M15_ALPHA = 1 - math.exp(-EWMA_DECAY_INTERVAL / 60.0 / 15)
 
-all_ewmas = []
+# Standalone EWMAs are decayed for as long as they are alive. They may be
+# unregistered early with close().
+all_ewmas = weakref.WeakKeyDictionary()
 
 
 class ExponentiallyWeightedMovingAverage (object):
 
+    __slots__ = ('alpha', 'interval', 'rate', 'uncounted', 'initialized', '__weakref__')
+
     def __init__ (self, alpha, interval):
         self.alpha = alpha
         self.interval = interval
@@ -39,7 +48,7 @@ class ExponentiallyWeightedMovingAverage (object):
         self.initialized = False
 
         global all_ewmas
-        all_ewmas.append(self)
+        all_ewmas[self] = True
 
     def initialize (self, rate, uncounted):
         self.rate = rate
@@ -61,6 +70,10 @@ class ExponentiallyWeightedMovingAverage (object):
     def averageValue (self):
         return self.rate
 
+    def close (self):
+        global all_ewmas
+        all_ewmas.pop(self, None)
+
 
 def one_minute_ewma ():
     return ExponentiallyWeightedMovingAverage(M1_ALPHA, EWMA_DECAY_INTERVAL)
@@ -73,9 +86,172 @@ def fifteen_minute_ewma ():
 
 ##############################################################################
 
+class RowReference (weakref.ref):
+    # A weak reference to the owner of an EWMAEngine row
+    __slots__ = ('row',)
+
+class EWMAEngine (object):
+    """
+    Keeps the 1, 5 and 15 minute EWMAs of many meters in contiguous arrays,
+    one row per meter, and decays all of them in one batched operation
+    (with numpy, if it is available). The three EWMAs of a meter are
+    always updated together, so a row has a single uncounted value.
+
+    Rows are freed when their owner is closed, or garbage collected. Free
+    rows are reused, and the arrays are compacted once more than half of
+    the rows are free, so that the decay cost follows the number of live
+    meters.
+    """
+
+    min_compact_size = 1024 # rows
+
+    def __init__ (self, alphas=(M1_ALPHA, M5_ALPHA, M15_ALPHA), interval=EWMA_DECAY_INTERVAL):
+        self.alphas = alphas
+        self.interval = interval
+        self.uncounted = array.array('d')
+        self.rates = [ array.array('d') for alpha in alphas ]
+        self.initialized = [ array.array('b') for alpha in alphas ]
+        self.free_rows = []
+        self.owners = {}
+
+    def allocate (self, owner):
+        if self.free_rows:
+            row = self.free_rows.pop()
+            self.uncounted[row] = 0.0
+            for rates, initialized in zip(self.rates, self.initialized):
+                rates[row] = 0.0
+                initialized[row] = 0
+        else:
+            row = len(self.uncounted)
+            self.uncounted.append(0.0)
+            for rates, initialized in zip(self.rates, self.initialized):
+                rates.append(0.0)
+                initialized.append(0)
+        ref = RowReference(owner, self.collected)
+        ref.row = row
+        self.owners[row] = ref
+        return row
+
+    def free (self, row):
+        if self.owners.pop(row, None) is None:
+            return
+        self.uncounted[row] = 0.0
+        self.free_rows.append(row)
+
+    def collected (self, ref):
+        # The owner of a row was garbage collected without being closed
+        self.free(ref.row)
+
+    def compact (self):
+        # Move the live rows from the end of the arrays into the free rows
+        # at the start, and truncate the arrays.
+        live = len(self.owners)
+        holes = [ row for row in self.free_rows if row < live ]
+        movers = [ row for row in self.owners if row >= live ]
+        for src, dst in zip(movers, holes):
+            self.uncounted[dst] = self.uncounted[src]
+            for rates, initialized in zip(self.rates, self.initialized):
+                rates[dst] = rates[src]
+                initialized[dst] = initialized[src]
+            ref = self.owners.pop(src)
+            ref.row = dst
+            self.owners[dst] = ref
+            owner = ref()
+            if owner is not None:
+                owner.row = dst
+        del self.uncounted[live:]
+        for rates, initialized in zip(self.rates, self.initialized):
+            del rates[live:]
+            del initialized[live:]
+        self.free_rows = []
+
+    def initialize (self, row, index, rate, uncounted):
+        self.rates[index][row] = rate
+        self.initialized[index][row] = 1
+        self.uncounted[row] = uncounted
+
+    def size (self):
+        return len(self.owners)
+
+    def decay (self):
+        if len(self.free_rows) > max(self.min_compact_size, len(self.owners)):
+            self.compact()
+        if not self.uncounted:
+            return
+        if numpy is not None:
+            self.decay_numpy()
+        else:
+            self.decay_array()
+
+    def decay_numpy (self):
+        # The numpy arrays are views on the array.array buffers, so they
+        # must not outlive this call: growing an array.array moves it.
+        uncounted = numpy.frombuffer(self.uncounted, dtype=numpy.float64)
+        instant = uncounted / self.interval
+        for alpha, rates, initialized in zip(self.alphas, self.rates, self.initialized):
+            rates = numpy.frombuffer(rates, dtype=numpy.float64)
+            initialized = numpy.frombuffer(initialized, dtype=numpy.int8)
+            fresh = initialized == 0
+            rates += alpha * (instant - rates)
+            if fresh.any():
+                numpy.copyto(rates, instant, where=fresh)
+                initialized[:] = 1
+        uncounted[:] = 0.0
+
+    def decay_array (self):
+        interval = self.interval
+        instant = [ count / interval for count in self.uncounted ]
+        for index, alpha in enumerate(self.alphas):
+            rates = self.rates[index]
+            initialized = self.initialized[index]
+            if 0 in initialized:
+                rates = [ (rate + alpha * (inst - rate)) if init else inst
+                          for rate, inst, init in zip(rates, instant, initialized) ]
+                self.initialized[index] = array.array('b', [1]) * len(instant)
+            else:
+                rates = [ rate + alpha * (inst - rate) for rate, inst in zip(rates, instant) ]
+            self.rates[index] = array.array('d', rates)
+        self.uncounted = array.array('d', [0.0]) * len(instant)
+
+class MeterRates (object):
+    """
+    A meter's handle on its row of an EWMAEngine.
+    """
+
+    __slots__ = ('engine', 'row', '__weakref__')
+
+    def __init__ (self, engine):
+        self.engine = engine
+        self.row = engine.allocate(self)
+
+    def update (self, n):
+        self.engine.uncounted[self.row] += n
+
+    def rate (self, index):
+        return self.engine.rates[index][self.row]
+
+    def uncounted (self):
+        return self.engine.uncounted[self.row]
+
+    def initialize (self, index, rate, uncounted):
+        self.engine.initialize(self.row, index, rate, uncounted)
+
+    def close (self):
+        if self.row is not None:
+            self.engine.free(self.row)
+            self.row = None
+
+meter_engine = EWMAEngine()
+
+def meter_rates ():
+    return MeterRates(meter_engine)
+
+##############################################################################
+
 def ewma_decay ():
     global all_ewmas
-    for ewma in all_ewmas:
+    meter_engine.decay()
+    for ewma in all_ewmas.keys():
         ewma.decay()
     schedule_ewma_decay()
 
@@ -85,10 +261,23 @@ def schedule_ewma_decay ():
 ##############################################################################
 
 class Sample (object):
+    """
+    Subclasses set 'dirty' whenever the sampled values change. Until then,
+    percentiles() answers from the results of the last query.
+    """
+
+    # True if the sampled values change with time alone
+    volatile = False
+
+    # True if the sample also gives the min, max, mean and stddev of its
+    # values, in summary()
+    windowed = False
 
     def __init__ (self, reservoirSize):
         self.reservoirSize = reservoirSize
         self.count = 0
+        self.dirty = True
+        self.cached_scores = {}
 
     def update (self, value):
         pass
@@ -97,9 +286,22 @@ class Sample (object):
         pass
 
     def percentiles (self, *percentiles):
+        if self.dirty:
+            self.dirty = False
+            self.cached_scores = {}
+        else:
+            scores = self.cached_scores.get(percentiles)
+            if scores is not None:
+                return scores[:]
+
+        scores = self.compute_percentiles(percentiles)
+        self.cached_scores[percentiles] = scores[:]
+        return scores
+
+    def compute_percentiles (self, percentiles):
         scores = [ 0.0 for p in percentiles ]
-        if self.count > 0:
-            values = self.values()
+        values = self.values()
+        if values:
             values.sort()
             for i in range(len(percentiles)):
                 p = percentiles[i]
@@ -124,10 +326,12 @@ class UniformSample (Sample):
         self.count += 1
         if self.count <= self.reservoirSize:
             self.reservoir[self.count - 1] = value
+            self.dirty = True
         else:
             r = random.randint(0, self.count -1)
             if r < self.reservoirSize:
                 self.reservoir[r] = value
+                self.dirty = True
 
     def values (self):
         if self.count > self.reservoirSize:
@@ -136,6 +340,11 @@ class UniformSample (Sample):
             return self.reservoir[:self.count]
 
 class ExponentiallyDecayingSample (Sample):
+    """
+    A forward-decaying priority reservoir. The reservoir is a min-heap of
+    (priority, value) pairs, so an update is O(log n): a new value either
+    replaces the lowest priority one, or is dropped.
+    """
 
     rescale_threshold = 60 * 60 # 1 hour
 
@@ -148,44 +357,176 @@ class ExponentiallyDecayingSample (Sample):
 
     def update (self, value):
         now = int(time.time())
-        priority = math.exp(self.alpha * (now - self.starttime)) / random.random()
-        val = (priority, value)
-        self.count += 1
-        if self.count <= self.reservoirSize:
-            self.reservoir.append(val)
-        else:
-            first = self.reservoir[0][0]
-            if first < priority:
-                self.reservoir.append(val)
-                del self.reservoir[0]
-        self.reservoir.sort()
-
-        if now > self.next_rescale_time:
+        if now >= self.next_rescale_time:
             self.rescale(now)
 
+        # 1 - random() is never zero
+        priority = math.exp(self.alpha * (now - self.starttime)) / (1.0 - random.random())
+        self.count += 1
+        reservoir = self.reservoir
+        if len(reservoir) < self.reservoirSize:
+            heapq.heappush(reservoir, (priority, value))
+            self.dirty = True
+        elif reservoir[0][0] < priority:
+            heapq.heapreplace(reservoir, (priority, value))
+            self.dirty = True
+
     def rescale (self, now):
+        # Scaling every priority by the same positive factor keeps the heap
+        # ordered, so the reservoir does not need to be re-heapified.
         self.next_rescale_time = now + ExponentiallyDecayingSample.rescale_threshold
-        new_reservoir = []
-        old_starttime = self.starttime
+        factor = math.exp(-self.alpha * (now - self.starttime))
         self.starttime = now
-        for priority,value in self.reservoir:
-            new_reservoir.append((priority * math.exp(-self.alpha * (self.starttime - old_starttime)), value))
-        self.reservoir = new_reservoir
+        self.reservoir = [ (priority * factor, value) for priority, value in self.reservoir ]
 
     def values (self):
-        if self.count > self.reservoirSize:
-            return [ v for p,v in self.reservoir ]
-        else:
-            return [ v for p,v in self.reservoir[:self.count] ]
+        return [ v for p,v in self.reservoir ]
 
     def dump (self):
         print "count = %d, reservoirSize = %d" % (self.count, self.reservoirSize)
-        if self.count > self.reservoirSize:
-            for p,v in self.reservoir:
-                print "%2.2f ... %s" % (p, v)
+        for p,v in sorted(self.reservoir):
+            print "%2.2f ... %s" % (p, v)
+
+
+class SlidingTimeWindowSample (Sample):
+    """
+    Holds the values of the last 'window' seconds in a ring of time
+    buckets. Whole buckets age out as the window slides. Each bucket keeps
+    a uniform sample of at most reservoirSize / buckets values, so memory
+    stays bounded however many values arrive. Percentiles weigh each kept
+    value by how many values of its bucket it stands for. The min, max,
+    mean and stddev are exact, from running totals kept per bucket.
+    """
+
+    default_buckets = 60
+    volatile = True
+    windowed = True
+
+    def __init__ (self, reservoirSize, window, buckets=None):
+        super(SlidingTimeWindowSample, self).__init__(reservoirSize)
+        if buckets is None:
+            buckets = self.default_buckets
+        self.window = float(window)
+        self.buckets = buckets
+        self.width = self.window / buckets
+        self.bucket_size = max(1, reservoirSize // buckets)
+        self.ring = [ [] for i in range(buckets) ]
+        self.ring_ticks = [ None ] * buckets
+        self.ring_counts = [ 0 ] * buckets
+        self.ring_mins = [ None ] * buckets
+        self.ring_maxs = [ None ] * buckets
+        self.ring_sums = [ 0.0 ] * buckets
+        self.ring_squares = [ 0.0 ] * buckets
+        self.snapshot_tick = None
+
+    def update (self, value):
+        tick = int(time.time() / self.width)
+        slot = tick % self.buckets
+        if self.ring_ticks[slot] != tick:
+            # Reuse the slot of a bucket that slid out of the window
+            self.ring_ticks[slot] = tick
+            self.ring[slot] = []
+            self.ring_counts[slot] = 0
+            self.ring_mins[slot] = value
+            self.ring_maxs[slot] = value
+            self.ring_sums[slot] = 0.0
+            self.ring_squares[slot] = 0.0
+        elif value < self.ring_mins[slot]:
+            self.ring_mins[slot] = value
+        elif value > self.ring_maxs[slot]:
+            self.ring_maxs[slot] = value
+        self.ring_sums[slot] += value
+        self.ring_squares[slot] += value * value
+
+        self.count += 1
+        bucket = self.ring[slot]
+        seen = self.ring_counts[slot] + 1
+        self.ring_counts[slot] = seen
+        if len(bucket) < self.bucket_size:
+            bucket.append(value)
+            self.dirty = True
         else:
-            for p,v in self.reservoir[:self.count]:
-                print "%2.2f ... %s" % (p, v)
+            r = random.randint(0, seen - 1)
+            if r < self.bucket_size:
+                bucket[r] = value
+                self.dirty = True
+
+    def live_slots (self):
+        # The ring slots holding buckets still in the window
+        oldest = int(time.time() / self.width) - self.buckets + 1
+        return [ slot for slot, tick in enumerate(self.ring_ticks) if tick is not None and tick >= oldest ]
+
+    def values (self):
+        values = []
+        for slot in self.live_slots():
+            values.extend(self.ring[slot])
+        return values
+
+    def percentiles (self, *percentiles):
+        # Values also change when a bucket ages out
+        tick = int(time.time() / self.width)
+        if tick != self.snapshot_tick:
+            self.snapshot_tick = tick
+            self.dirty = True
+        return super(SlidingTimeWindowSample, self).percentiles(*percentiles)
+
+    def compute_percentiles (self, percentiles):
+        # A busy bucket keeps the same number of values as a quiet one, so
+        # each value is weighted by the count of values it stands for, and
+        # ranked at the middle of the ranks it covers. With every weight 1
+        # this is the plain Sample computation.
+        weighted = []
+        for slot in self.live_slots():
+            bucket = self.ring[slot]
+            if not bucket: continue
+            weight = self.ring_counts[slot] / float(len(bucket))
+            weighted.extend([ (value, weight) for value in bucket ])
+        if not weighted:
+            return [ 0.0 for p in percentiles ]
+
+        weighted.sort()
+        ranks = []
+        total = 0.0
+        for value, weight in weighted:
+            ranks.append(total + (weight + 1.0) / 2.0)
+            total += weight
+
+        scores = []
+        for p in percentiles:
+            pos = p * (total + 1)
+            i = bisect.bisect_right(ranks, pos)
+            if i == 0:
+                scores.append(weighted[0][0])
+            elif i == len(ranks):
+                scores.append(weighted[-1][0])
+            else:
+                lower, upper = weighted[i - 1][0], weighted[i][0]
+                fraction = (pos - ranks[i - 1]) / (ranks[i] - ranks[i - 1])
+                scores.append(lower + fraction * (upper - lower))
+        return scores
+
+    def summary (self):
+        # (min, max, mean, stddev) of every value in the window
+        count = 0
+        total = 0.0
+        squares = 0.0
+        low = high = None
+        for slot in self.live_slots():
+            if not self.ring_counts[slot]: continue
+            count += self.ring_counts[slot]
+            total += self.ring_sums[slot]
+            squares += self.ring_squares[slot]
+            if low is None or self.ring_mins[slot] < low:
+                low = self.ring_mins[slot]
+            if high is None or self.ring_maxs[slot] > high:
+                high = self.ring_maxs[slot]
+        if count == 0:
+            return (0.0, 0.0, 0.0, 0.0)
+        mean = total / count
+        variance = 0.0
+        if count > 1:
+            variance = max(0.0, (squares - total * mean) / (count - 1))
+        return (low, high, mean, math.sqrt(variance))
 
 
 def one_minute_eds ():
@@ -197,5 +538,117 @@ def five_minute_eds ():
 def fifteen_minute_eds ():
     return ExponentiallyDecayingSample(1028, M15_ALPHA)
 
+##############################################################################
+
+class DDSketch (Sample):
+    """
+    A quantile sketch with relative accuracy guarantees (DDSketch). Values
+    are counted in logarithmically sized buckets, so any quantile is
+    answered within 'relative_accuracy' of the true value. Updates are
+    O(1), memory is bounded by 'max_buckets', and two sketches with the
+    same accuracy can be merged.
+    """
+
+    default_relative_accuracy = 0.01
+    default_max_buckets = 2048
+
+    def __init__ (self, relative_accuracy=None, max_buckets=None):
+        if relative_accuracy is None:
+            relative_accuracy = self.default_relative_accuracy
+        if max_buckets is None:
+            max_buckets = self.default_max_buckets
+        if not 0.0 < relative_accuracy < 1.0:
+            raise ValueError('relative accuracy must be between 0 and 1')
+        super(DDSketch, self).__init__(max_buckets)
+        self.relative_accuracy = relative_accuracy
+        self.max_buckets = max_buckets
+        self.gamma = (1.0 + relative_accuracy) / (1.0 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.min_indexable = sys.float_info.min * self.gamma
+        self.positive = {}
+        self.negative = {}
+        self.zero_count = 0
+
+    def update (self, value):
+        self.count += 1
+        self.dirty = True
+        if value > self.min_indexable:
+            store = self.positive
+        elif value < -self.min_indexable:
+            store = self.negative
+            value = -value
+        else:
+            self.zero_count += 1
+            return
+        key = int(math.ceil(math.log(value) / self.log_gamma))
+        store[key] = store.get(key, 0) + 1
+        if len(store) > self.max_buckets:
+            self.collapse(store)
+
+    def collapse (self, store):
+        # Fold the lowest buckets into one, leaving some room so that this
+        # is not done again for every new bucket
+        keys = sorted(store)
+        target = keys[len(keys) - (self.max_buckets * 9 // 10)]
+        folded = 0
+        for key in keys:
+            if key >= target: break
+            folded += store.pop(key)
+        store[target] += folded
+
+    def bucket_value (self, key):
+        return 2.0 * self.gamma ** key / (self.gamma + 1.0)
+
+    def merge (self, other):
+        if other.gamma != self.gamma:
+            raise ValueError('cannot merge sketches with different accuracies')
+        for store, other_store in ((self.positive, other.positive), (self.negative, other.negative)):
+            for key, count in other_store.iteritems():
+                store[key] = store.get(key, 0) + count
+            if len(store) > self.max_buckets:
+                self.collapse(store)
+        self.zero_count += other.zero_count
+        self.count += other.count
+        self.dirty = True
+
+    def compute_percentiles (self, percentiles):
+        scores = [ 0.0 for p in percentiles ]
+        if self.count == 0:
+            return scores
+
+        # Walk the buckets from the lowest value up: the negative buckets
+        # by descending key, then the zeros, then the positive buckets.
+        buckets = [ (-self.bucket_value(key), self.negative[key])
+                    for key in sorted(self.negative, reverse=True) ]
+        if self.zero_count:
+            buckets.append((0.0, self.zero_count))
+        buckets.extend([ (self.bucket_value(key), self.positive[key])
+                         for key in sorted(self.positive) ])
+
+        order = sorted(range(len(percentiles)), key=lambda i: percentiles[i])
+        pos, seen = 0, buckets[0][1]
+        for i in order:
+            rank = percentiles[i] * (self.count - 1)
+            while seen <= rank and pos < len(buckets) - 1:
+                pos += 1
+                seen += buckets[pos][1]
+            scores[i] = buckets[pos][0]
+        return scores
+
+    def to_dict (self):
+        return { 'relative_accuracy': self.relative_accuracy,
+                 'zero_count': self.zero_count,
+                 'positive': dict([ (str(k), c) for k, c in self.positive.iteritems() ]),
+                 'negative': dict([ (str(k), c) for k, c in self.negative.iteritems() ]), }
+
+    def from_dict (cls, data, max_buckets=None):
+        sketch = cls(data['relative_accuracy'], max_buckets)
+        sketch.zero_count = data['zero_count']
+        sketch.positive = dict([ (int(k), c) for k, c in data['positive'].iteritems() ])
+        sketch.negative = dict([ (int(k), c) for k, c in data['negative'].iteritems() ])
+        sketch.count = sketch.zero_count + sum(sketch.positive.values()) + sum(sketch.negative.values())
+        return sketch
+    from_dict = classmethod(from_dict)
+
 ##############################################################################
 ## THE END
@@ -14,7 +14,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import os, socket, sys
+import inspect, os, socket, sys
 
 ##############################################################################
 
@@ -60,6 +60,17 @@ def find_python_object (name, module=None):
                 raise ImportError(err)
         return eval(name)
 
+def accepts_keyword (obj, keyword):
+    # True if the callable obj (a class for one) takes the keyword argument
+    if inspect.isclass(obj):
+        obj = obj.__init__
+    try:
+        args, _varargs, varkw, _defaults = inspect.getargspec(obj)
+    except TypeError:
+        # Not written in python
+        return False
+    return keyword in args or varkw is not None
+
 ##############################################################################
 
 _ctypes, _ctypes_util = None, None
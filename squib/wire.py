@@ -0,0 +1,228 @@
+# vim:set ts=4 sw=4 et nowrap syntax=python ff=unix:
+#
+# Copyright 2011-2018 Mark Crewson <mark@crewson.net>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import struct, sys, time
+
+from mccorelib.log import getlog
+
+##############################################################################
+#
+# Oxidizers talk to the parent over their stdout, in one of two protocols:
+#
+#   text   - one "name [type] value" line per metric.
+#
+#   binary - a stream of length-prefixed frames. Every frame starts with
+#            its total length (including the length itself) and a frame
+#            kind. A DEFINE frame binds a metric id to a "name type" pair,
+#            and the value frames after it only carry the id and a packed
+#            value.
+#
+
+FRAME_DEFINE  = 1
+FRAME_INTEGER = 2
+FRAME_FLOAT   = 3
+FRAME_STRING  = 4
+
+FRAME_HEADER  = struct.Struct('!HB')
+FRAME_ID      = struct.Struct('!HBI')
+INTEGER_FRAME = struct.Struct('!HBIq')
+FLOAT_FRAME   = struct.Struct('!HBId')
+
+pack_integer = INTEGER_FRAME.pack
+pack_float   = FLOAT_FRAME.pack
+
+MAX_FRAME_LENGTH = 65535
+
+WIRE_PROTOCOLS = ('text', 'binary')
+
+##############################################################################
+
+class TextEmitter (object):
+
+    def emit (self, name, value, mtype=None):
+        if mtype is None:
+            sys.stdout.write('%s %s\n' % (name, value))
+        else:
+            sys.stdout.write('%s %s %s\n' % (name, mtype, value))
+
+    def flush (self):
+        sys.stdout.flush()
+
+##############################################################################
+
+class FrameEncoder (object):
+
+    def __init__ (self):
+        self.metric_ids = {}
+
+    def encode (self, frames, name, value, mtype=None):
+        mid = self.metric_ids.get((name, mtype))
+        if mid is None:
+            mid = self.define(frames, name, mtype)
+
+        vtype = value.__class__
+        if vtype is int or vtype is long:
+            frames.append(pack_integer(INTEGER_FRAME.size, FRAME_INTEGER, mid, value))
+        elif vtype is float:
+            frames.append(pack_float(FLOAT_FRAME.size, FRAME_FLOAT, mid, value))
+        else:
+            frames.append(self.frame(FRAME_STRING, mid, str(value)))
+
+    def define (self, frames, name, mtype):
+        mid = len(self.metric_ids) + 1
+        self.metric_ids[(name, mtype)] = mid
+        if mtype is None:
+            mtype = 'gauge'
+        frames.append(self.frame(FRAME_DEFINE, mid, '%s %s' % (name, mtype)))
+        return mid
+
+    def frame (self, kind, mid, payload):
+        length = FRAME_ID.size + len(payload)
+        if length > MAX_FRAME_LENGTH:
+            raise ValueError('metric frame too long (%d bytes)' % length)
+        return FRAME_ID.pack(length, kind, mid) + payload
+
+class BinaryEmitter (object):
+
+    max_pending_frames = 4096
+
+    def __init__ (self):
+        self.encoder = FrameEncoder()
+        self.frames = []
+
+    def emit (self, name, value, mtype=None):
+        self.encoder.encode(self.frames, name, value, mtype)
+        if len(self.frames) >= self.max_pending_frames:
+            self.flush()
+
+    def flush (self):
+        if self.frames:
+            sys.stdout.write(''.join(self.frames))
+            self.frames = []
+        sys.stdout.flush()
+
+def create_emitter (protocol):
+    if protocol == 'binary':
+        return BinaryEmitter()
+    return TextEmitter()
+
+##############################################################################
+
+class FrameDecoder (object):
+
+    def __init__ (self, metrics_recorder, ttl=None):
+        self.metrics_recorder = metrics_recorder
+        self.ttl = ttl
+        self.buff = bytearray()
+        self.definitions = {}
+        self.metrics = {}
+        self.generation = metrics_recorder.generation
+        self.log = getlog()
+
+    def feed (self, data):
+        if self.generation != self.metrics_recorder.generation:
+            self.forget()
+        buff = self.buff
+        buff += data
+        end = len(buff)
+        pos = 0
+        metrics = self.metrics
+        unpack_header = FRAME_HEADER.unpack_from
+        unpack_integer = INTEGER_FRAME.unpack_from
+        unpack_float = FLOAT_FRAME.unpack_from
+        now = time.time()
+        recorded = 0
+        try:
+            while end - pos >= FRAME_HEADER.size:
+                length, kind = unpack_header(buff, pos)
+                if length < FRAME_ID.size:
+                    self.log.error('Corrupt metric frame (length %d). Discarding %d bytes' % (length, end - pos))
+                    pos = end
+                    break
+                if end - pos < length:
+                    break
+
+                # A whole frame is consumed, whatever becomes of its value,
+                # so that no frame is ever applied twice
+                start = pos
+                pos += length
+                if kind == FRAME_INTEGER and length == INTEGER_FRAME.size:
+                    _length, _kind, mid, value = unpack_integer(buff, start)
+                elif kind == FRAME_FLOAT and length == FLOAT_FRAME.size:
+                    _length, _kind, mid, value = unpack_float(buff, start)
+                elif kind == FRAME_STRING:
+                    _length, _kind, mid = FRAME_ID.unpack_from(buff, start)
+                    value = str(buff[start+FRAME_ID.size:pos])
+                elif kind == FRAME_DEFINE:
+                    _length, _kind, mid = FRAME_ID.unpack_from(buff, start)
+                    self.define(mid, str(buff[start+FRAME_ID.size:pos]))
+                    continue
+                else:
+                    self.log.error('Unknown metric frame (kind %d, length %d). Discarding %d bytes' % (kind, length, end - start))
+                    pos = end
+                    break
+
+                m = metrics.get(mid)
+                if m is None:
+                    m = self.lookup(mid)
+                    metrics = self.metrics
+                    if m is None:
+                        continue
+                try:
+                    if kind == FRAME_STRING:
+                        m.update(value)
+                    else:
+                        m.update_number(value)
+                except Exception, why:
+                    self.log.warning('Ignored invalid value for metric %s: %s' % (m.name, str(why)))
+                    continue
+                m.last_update = now
+                recorded += 1
+        finally:
+            del buff[:pos]
+            if recorded:
+                self.metrics_recorder.mark_recorded(recorded)
+
+    def define (self, mid, definition):
+        try:
+            name, mtype = definition.split(' ', 1)
+        except ValueError:
+            self.log.warning('Invalid metric definition: %s' % definition)
+            return
+        self.definitions[mid] = (name, mtype)
+        self.metrics.pop(mid, None)
+
+    def lookup (self, mid):
+        # Ids are looked up in the recorder on their first value, and again
+        # on their next value after the recorder dropped metrics. Metrics
+        # evicted or expired while no values arrive for them stay gone.
+        definition = self.definitions.get(mid)
+        if definition is None:
+            return None
+        m = self.metrics_recorder.lookup_metric(definition[0], definition[1], self.ttl)
+        if self.generation != self.metrics_recorder.generation:
+            # The lookup evicted metrics, possibly some of ours
+            self.forget()
+        self.metrics[mid] = m
+        return m
+
+    def forget (self):
+        # Metrics were dropped from the recorder since they were looked up
+        self.generation = self.metrics_recorder.generation
+        self.metrics = {}
+
+##############################################################################
+## THE END
@@ -0,0 +1,68 @@
+# vim:set ts=4 sw=4 et nowrap syntax=python ff=unix:
+#
+# Copyright 2011-2018 Mark Crewson <mark@crewson.net>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+
+from squib import metrics
+
+##############################################################################
+
+class RecordManyTest (unittest.TestCase):
+
+    def setUp (self):
+        self.recorder = metrics.MetricsRecorder()
+
+    def test_bad_line_mid_batch (self):
+        self.recorder.record_many([ 'x counter 1', 'y counter abc', 'z counter 3' ])
+        self.assertEqual(self.recorder.all_metrics['x:CounterMetric:None'].count, 1)
+        self.assertEqual(self.recorder.all_metrics['z:CounterMetric:None'].count, 3)
+        self.assertEqual(self.recorder.all_metrics['y:CounterMetric:None'].count, 0)
+
+    def test_bad_line_counted_out (self):
+        class Stats (object):
+            recorded = 0
+            def mark_metrics_record (inself, count=1):
+                inself.recorded += count
+        stats = Stats()
+        self.recorder.set_selfstats(stats)
+        self.recorder.record_many([ 'x counter 1', 'y counter abc', 'z 3' ])
+        self.assertEqual(stats.recorded, 2)
+
+##############################################################################
+
+class TimerTest (unittest.TestCase):
+
+    def test_fractional_durations (self):
+        recorder = metrics.MetricsRecorder()
+        recorder.record_many([ 'req timer 12.5', 'req timer 7.5', 'req timer 10' ])
+        timer = recorder.all_metrics['req:TimerMetric:None']
+        self.assertEqual(timer.count, 3)
+        self.assertEqual(timer.min_val, 7.5)
+        self.assertEqual(timer.max_val, 12.5)
+        self.assertEqual(timer.mean_rate(), 10.0)
+
+    def test_bad_duration (self):
+        recorder = metrics.MetricsRecorder()
+        recorder.record_many([ 'req timer fast' ])
+        self.assertEqual(recorder.all_metrics['req:TimerMetric:None'].count, 0)
+
+##############################################################################
+
+if __name__ == '__main__':
+    unittest.main()
+
+##############################################################################
+## THE END
@@ -0,0 +1,69 @@
+# vim:set ts=4 sw=4 et nowrap syntax=python ff=unix:
+#
+# Copyright 2011-2018 Mark Crewson <mark@crewson.net>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+
+from squib import metrics, reporter
+
+##############################################################################
+
+class Snapshot (object):
+
+    def __init__ (self, datapoints):
+        self._datapoints = datapoints
+
+    def datapoints (self):
+        return self._datapoints
+
+def statsd_reporter (max_packet_size):
+    config = { 'destination_addr': '127.0.0.1', 'destination_port': '8125',
+               'max_packet_size': str(max_packet_size) }
+    return reporter.StatsdReporter(config, metrics.MetricsRecorder())
+
+##############################################################################
+
+class StatsdPackingTest (unittest.TestCase):
+
+    # 16 and 25 bytes
+    POSITIVE = ('b.value', (0, 12345))
+    NEGATIVE = ('a.value', (0, -3))
+
+    def test_negative_gauge_not_split (self):
+        # The reset line would fit after the first line, the value would not
+        statsd = statsd_reporter(30)
+        datagrams, oversized = statsd.build_datagrams(Snapshot([ self.POSITIVE, self.NEGATIVE ]))
+        self.assertEqual(datagrams, [ 'b.value:12345|g\n', 'a.value:0|g\na.value:-3|g\n' ])
+        self.assertEqual(oversized, 0)
+
+    def test_negative_gauge_at_packet_size (self):
+        statsd = statsd_reporter(25)
+        datagrams, oversized = statsd.build_datagrams(Snapshot([ self.NEGATIVE, self.NEGATIVE ]))
+        self.assertEqual(datagrams, [ 'a.value:0|g\na.value:-3|g\n' ] * 2)
+        self.assertEqual(oversized, 0)
+
+    def test_negative_gauge_over_packet_size (self):
+        statsd = statsd_reporter(24)
+        datagrams, oversized = statsd.build_datagrams(Snapshot([ self.POSITIVE, self.NEGATIVE ]))
+        self.assertEqual(datagrams, [ 'b.value:12345|g\n' ])
+        self.assertEqual(oversized, 1)
+
+##############################################################################
+
+if __name__ == '__main__':
+    unittest.main()
+
+##############################################################################
+## THE END